@@ -1,11 +1,21 @@
 import json
+import logging
+import os
+import re
+import asyncio
 import time
 import datetime
 import random
+import hashlib
+import bisect
+import heapq
+import sys
 import aiohttp
 
-from typing import Dict, Optional
+from typing import Dict, List, NamedTuple, Optional
+from collections import OrderedDict, deque
 from dataclasses import dataclass
+from itertools import islice
 
 from pathlib import Path
 
@@ -16,8 +26,135 @@ from astrbot.api import logger
 from astrbot.api.star import StarTools
 from astrbot.api.provider import LLMResponse, ProviderRequest
 
+try:
+    import orjson  # 可选依赖，解析速度更快
+except ImportError:
+    orjson = None
+
+# 匹配最外层JSON对象，用于从夹带说明文字的模型回复中提取JSON
+_JSON_OBJECT_RE = re.compile(r'\{.*\}', re.DOTALL)
+# 仅由链接组成的消息，预过滤时直接跳过判断
+_URL_ONLY_RE = re.compile(r'(?:https?://\S+\s*)+')
+
+
+def _json_loads(data):
+    """解析JSON，已安装orjson时优先使用"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_load_file(path: Path):
+    """读取JSON文件，orjson可用时按字节读取并解析"""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _json_dump_file(path: Path, data, indent: bool = True):
+    """写入JSON文件（保留中文），orjson可用时一次性写入字节
+
+    indent=True 时缩进2格便于查看，False 时输出不含空白的紧凑格式。
+    先写入同目录的临时文件再替换原文件，写入中途崩溃不会留下损坏的数据文件
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        payload = orjson.dumps(data, option=option)
+    elif indent:
+        payload = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+    else:
+        payload = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode("utf-8")
+
+    # 整体序列化后一次写入，落盘后再替换，避免断电时替换出未写完的文件
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _strip_json_fence(content: str) -> str:
+    """去除模型回复首尾的 ```json / ``` 代码块标记，不影响内容中间的反引号"""
+    content = content.strip()
+    if content.startswith("```"):
+        content = content.removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+    return content
+
+
+# 消息链组件类型与插件媒体类型的对应关系
+_COMPONENT_MEDIA_TYPES = {"Image": "image", "Record": "audio", "Video": "video", "File": "file"}
+_MEDIA_COMPONENT_TYPES = {media: component for component, media in _COMPONENT_MEDIA_TYPES.items()}
+# 媒体类型对应的中文标签，未知类型统一标为"媒体"
+_MEDIA_LABELS = {"image": "图片", "audio": "语音", "video": "视频", "file": "文件"}
+# 会话显式取消人格时的人格ID；与驻留后的人格ID比较时可直接命中身份比较
+_NO_PERSONA = sys.intern("[%None]")
+# 小模型上下文中的角色标注
+_CONTEXT_LABELS = {"user": "[群友消息] ", "assistant": "[我的回复] "}
+# 好感度等级：_FAV_LEVEL_THRESHOLDS[i] 为 _FAV_LEVELS[i + 1] 的下限
+_FAV_LEVEL_THRESHOLDS = (20, 35, 65, 75, 85)
+_FAV_LEVELS = (
+    ("冷淡", "😒"),
+    ("陌生", "😑"),
+    ("普通", "😐"),
+    ("熟人", "🙂"),
+    ("好友", "😊"),
+    ("挚友", "💖")
+)
+# 质量分（0-1）到好感度变化的分段线性映射：区间 (上界] 内 delta = 斜率 * q + 截距
+# 区间依次为 [0,0.2] (0.2,0.4] (0.4,0.6] (0.6,0.8] (0.8,1]
+_FAV_DELTA_BOUNDS = (0.2, 0.4, 0.6, 0.8)
+_FAV_DELTA_SLOPES = (12.5, 7.5, 9.0, 6.0, 5.0)
+_FAV_DELTA_INTERCEPTS = (-5.0, -4.0, -4.6, -2.8, -2.0)
+# 心流状态报告模板，配置相关字段见 HeartflowPlugin._status_static_fields
+_STATUS_TEMPLATE = """
+心流状态报告
+
+当前状态:
+- 群聊ID: {chat_id}
+- 精力水平: {energy:.2f}/1.0 {energy_level}
+- 上次回复: {minutes_since_reply}分钟前
+
+历史统计:
+- 总消息数: {total_messages}
+- 总回复数: {total_replies}
+- 回复率: {reply_rate:.1f}%
+
+配置参数:
+        - 回复阈值: {reply_threshold}
+        - 判断提供商: {judge_provider_name}
+        - 白名单模式: {whitelist_mode}
+- 白名单群聊数: {whitelist_count}
+
+智能缓存:
+- 系统提示词缓存: {prompt_cache_count} 个
+- 消息缓冲区: {buffer_count}/{max_buffer_size} 条
+
+评分权重:
+- 内容相关度: {weight_relevance:.0%}
+- 回复意愿: {weight_willingness:.0%}
+- 社交适宜性: {weight_social:.0%}
+- 时机恰当性: {weight_timing:.0%}
+- 对话连贯性: {weight_continuity:.0%}
+
+{fav_stats}
+"""
+# 缓冲区状态展示中的角色名称
+_ROLE_USER_TEXT = "群友"
+_ROLE_BOT_TEXT = "我"
+
 
-@dataclass
+class BufferedMessage(NamedTuple):
+    """缓冲区消息（元组存储，比字典更省内存、读取更快）"""
+    role: str
+    content: str
+    timestamp: float
+    labeled: str  # 写入时预先拼好角色标注的内容，供小模型判断使用
+
+
+@dataclass(slots=True)
 class JudgeResult:
     """判断结果数据类"""
     relevance: float = 0.0
@@ -37,7 +174,7 @@ class JudgeResult:
             self.related_messages = []
 
 
-@dataclass
+@dataclass(slots=True)
 class ChatState:
     """群聊状态数据类"""
     energy: float = 1.0
@@ -64,6 +201,9 @@ class HeartflowPlugin(star.Star):
         super().__init__(context)
         self.config = config
 
+        # 心流总开关：配置变更时插件会重新加载，这里缓存为属性供各钩子快速判断
+        self.enable_heartflow = bool(self.config.get("enable_heartflow", False))
+
         # 判断模型配置
         self.judge_provider_name = self.config.get("judge_provider_name", "")
         
@@ -81,16 +221,23 @@ class HeartflowPlugin(star.Star):
         self.context_messages_count = self.config.get("context_messages_count", 5)
         self.whitelist_enabled = self.config.get("whitelist_enabled", False)
         self.chat_whitelist = self.config.get("chat_whitelist", [])
+        # 白名单成员判断用的集合，每条消息都会检查
+        self._whitelist_set = frozenset(self.chat_whitelist)
 
         # 群聊状态管理
         self.chat_states: Dict[str, ChatState] = {}
+        # 今日日期缓存：跨过本地零点（_today_expire）后才重新计算日期字符串
+        self._today_iso = ""
+        self._today_expire = 0.0
         
-        # 获取插件数据目录
+        # 获取插件数据目录（首次保存时创建，之后的保存不再重复调用 mkdir）
+        self._data_dir_ready = False
         try:
             self.data_dir = StarTools.get_data_dir(None)  # 自动检测插件名称
             self.favorability_file = self.data_dir / "favorability.json"
             self.global_favorability_file = self.data_dir / "global_favorability.json"
             self.blacklist_file = self.data_dir / "blacklist.json"  # 新增：拉黑状态文件
+            self.summary_cache_file = self.data_dir / "summary_cache.json"  # 精简人格提示词持久化缓存
             logger.info(f"插件数据目录: {self.data_dir}")
         except Exception as e:
             logger.error(f"获取数据目录失败，好感度系统已禁用: {e}")
@@ -99,9 +246,39 @@ class HeartflowPlugin(star.Star):
             self.favorability_file = None
             self.global_favorability_file = None
             self.blacklist_file = None
+            self.summary_cache_file = None
         
         # 系统提示词缓存：{conversation_id: {"original": str, "summarized": str, "persona_id": str}}
-        self.system_prompt_cache: Dict[str, Dict[str, str]] = {}
+        # 按LRU淘汰，最多保留 max_prompt_cache 个会话，避免随会话数量无限增长
+        self.system_prompt_cache: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+        self.max_prompt_cache = max(1, self.config.get("max_prompt_cache", 128))
+
+        # 人格索引：{人格名称: 人格字典}，人格列表对象或长度变化时重建
+        # 保存列表对象本身而非 id()：持有引用保证旧列表不会被释放，其 id 也就不会被新列表复用
+        self._persona_index: Dict[str, dict] = {}
+        self._persona_list_ref = None
+        self._persona_list_len = 0
+        # 人格系统提示词短期缓存：{unified_msg_origin: (解析时间, 提示词)}
+        # 人格极少在对话中途切换，缓存期内无需重复查询会话管理器
+        self._persona_prompt_cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self._persona_cache_ttl = 30.0
+        self._persona_cache_size = 256
+        # 会话元信息短期缓存：{unified_msg_origin: (查询时间, 会话ID, 会话是否存在, 人格ID)}
+        # 与人格提示词缓存共用TTL和容量上限
+        self._conv_meta_cache: "OrderedDict[str, tuple]" = OrderedDict()
+        # 正在进行的会话元信息查询：{unified_msg_origin: Task}，消息突发时只查询一次会话管理器
+        self._conv_meta_inflight: Dict[str, asyncio.Task] = {}
+        
+        # 精简提示词持久化缓存：{完整总结请求哈希: 精简提示词}
+        # 按总结请求内容（总结指令+原始提示词）而非会话缓存，重启后及共享同一人格的会话都无需再次调用小模型总结；
+        # 修改总结指令后哈希随之变化，旧总结不再命中。按LRU淘汰，最多保留 _summary_cache_max 条
+        self.summary_cache: "OrderedDict[str, str]" = OrderedDict()
+        self._summary_cache_max = 256
+        self._summary_cache_dirty = False
+        # 正在进行的总结任务：{总结请求哈希: Task}，并发的相同请求共享一次小模型调用
+        self._summarize_inflight: Dict[str, asyncio.Task] = {}
+        if self.summary_cache_file:
+            self._load_summary_cache()
         
         # 媒体识别状态：防止钩子拦截插件自身的媒体识别请求
         self.media_recognition_sessions: set = set()
@@ -119,7 +296,7 @@ class HeartflowPlugin(star.Star):
         
         # ===== 消息历史缓冲机制 =====
         # 用于保存完整的消息历史，包括未回复的消息
-        # 结构：{chat_id: [{"role": str, "content": str, "timestamp": float}]}
+        # 结构：{chat_id: deque([BufferedMessage(role, content, timestamp, labeled)], maxlen=max_buffer_size)}
         # 
         # 为什么需要这个缓冲区？
         # - AstrBot的conversation_manager只保存被回复的消息
@@ -131,7 +308,8 @@ class HeartflowPlugin(star.Star):
         # 3. 判断时：使用缓冲区的完整历史
         #
         # 注意：缓冲区采用"从现在开始记录"策略，不回溯历史
-        self.message_buffer: Dict[str, list] = {}
+        # 缓冲区使用定长deque，超出容量时自动丢弃最旧的消息
+        self.message_buffer: Dict[str, deque] = {}
         self.max_buffer_size = self.config.get("max_buffer_size", 50)  # 每个群聊最多缓存50条
         
         # ===== 智能记忆系统 =====
@@ -141,17 +319,66 @@ class HeartflowPlugin(star.Star):
         # ===== AI拉黑系统 =====
         # 结构：{user_id: bool} - 简单的拉黑状态
         self.blacklist_system: Dict[str, bool] = {}
+        # 拉黑状态延迟保存：短时间内的多次变更合并为一次后台写入
+        self._blacklist_dirty = False
+        self._blacklist_save_task: Optional[asyncio.Task] = None
+        self._blacklist_save_delay = 2.0
+        self._blacklist_save_lock = asyncio.Lock()
+        self._blacklist_flush_now = asyncio.Event()  # 设置后延迟保存立即执行
         
         # 判断状态标记：用于过滤小模型的判断结果
-        self.judging_sessions: set = set()  # 正在进行判断的会话ID集合
+        self.judging_sessions: set[str] = set()  # 正在进行判断的会话ID集合
 
         # 判断配置
         self.judge_include_reasoning = self.config.get("judge_include_reasoning", True)
+        # 小模型并发上限：多个群聊同时判断时共享，避免突发请求压垮提供商
+        self.judge_max_concurrency = max(1, self.config.get("judge_max_concurrency", 8))
+        self._judge_semaphore = asyncio.Semaphore(self.judge_max_concurrency)
+        # 回复概率判定使用插件独立的随机数生成器，不与其他插件共享全局随机状态
+        self._rng = random.Random()
+        # 规则预过滤：过短、纯链接、同一用户重复发送的消息不调用小模型
+        self.enable_judge_prefilter = self.config.get("enable_judge_prefilter", True)
+        # 各用户在群聊中的上一条文本消息：{(群聊ID, 用户ID): (消息哈希, 时间戳)}
+        # 只保存哈希用于相等判断；按时间先后排列（LRU），从最旧一端淘汰过期记录，并限制最多 _prefilter_max_entries 条
+        self._last_user_message: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._prefilter_repeat_window = 300.0
+        self._prefilter_max_entries = 4096
+        # 判断合并：同一群聊同时只进行一次判断，期间到达的消息只判断最新一条
+        self.enable_judge_coalescing = self.config.get("enable_judge_coalescing", True)
+        self._judge_inflight: Dict[str, asyncio.Event] = {}  # {群聊ID: 当前判断完成事件}
+        self._judge_seq: Dict[str, int] = {}  # {群聊ID: 最新分配的消息序号}
+        self._judge_waiting: Dict[str, List[int]] = {}  # {群聊ID: 仍在等待判断的消息序号（升序）}
         
         # 提示词配置
         self.judge_evaluation_rules = self.config.get("judge_evaluation_rules", "")
         self.summarize_instruction = self.config.get("summarize_instruction", "")
-        
+
+        # 总结提示词模板：指令部分只依赖配置，初始化时确定，调用时只拼接原始角色设定
+        # 使用配置的总结指令，如果没有配置则使用默认指令
+        summarize_instruction = self.summarize_instruction or "请将以下机器人角色设定总结为简洁的核心要点，保留关键的性格特征、行为方式和角色定位。总结后的内容应该在100-200字以内，突出最重要的角色特点。"
+        self._summarize_prompt_head = f"{summarize_instruction}\n\n原始角色设定：\n"
+        self._summarize_prompt_tail = """
+
+请以JSON格式回复：
+{
+    "summarized_persona": "精简后的角色设定，保留核心特征和行为方式"
+}
+
+重要：你的回复必须是完整的JSON对象，不要包含任何其他内容！"""
+
+        # 判断提示词的静态部分只依赖配置，初始化时构建一次
+        self._judge_rules_prompt = self._build_judge_rules_prompt()
+        # 判断提示词前缀缓存：{人格提示词: 静态前缀}
+        # 前缀作为系统提示词发送，位于对话历史之前，同一人格下保持字节一致，便于命中提供商的前缀缓存
+        self._judge_prefix_cache: Dict[str, str] = {}
+        # 当前时间字符串缓存：(整秒时间戳, "HH:MM:SS")，同一秒内的消息复用格式化结果
+        self._time_str_cache = (0, "")
+        # 判断评分缓存：{(群聊, 用户, 人格ID, 上下文签名, 归一化消息, 精力, 距上次回复分钟数档位, 好感度等级): (时间, 评分JSON)}
+        # 同一用户在上下文不变时短时间内重复发送（"哈哈"、"?"等）复用评分，省去一次小模型调用
+        self._judge_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._judge_cache_ttl = 60.0
+        self._judge_cache_max = 512
+
         # 好感度系统配置
         self.enable_favorability = self.config.get("enable_favorability", False)
         self.enable_global_favorability = self.config.get("enable_global_favorability", False)
@@ -170,6 +397,10 @@ class HeartflowPlugin(star.Star):
         # 跨群聊的用户好感度，不受白名单限制
         self.global_favorability: Dict[str, float] = {}
         self.global_interaction_count: Dict[str, int] = {}
+        # 好感度数据自上次保存后是否有变更，无变更时跳过写文件
+        self._favorability_dirty = False
+        # 保存锁：手动保存与卸载保存可能同时发生，逐个写入，避免并发写同一临时文件
+        self._favorability_save_lock = asyncio.Lock()
         
         # 好感度计算权重
         self.fav_weights = {
@@ -179,22 +410,25 @@ class HeartflowPlugin(star.Star):
             "willingness": self.config.get("fav_weight_willingness", 0.05),
             "timing": self.config.get("fav_weight_timing", 0.05)
         }
+        # 好感度质量分用的权重元组：(相关度, 社交, 连贯性, 意愿, 时机)
+        # 预先除以10，直接与0-10的原始分数相乘即得0-1的质量分
+        self._fav_weight_vec = tuple(
+            self.fav_weights[k] / 10.0
+            for k in ("relevance", "social", "continuity", "willingness", "timing")
+        )
         
-        # 判断权重配置
-        self.weights = {
-            "relevance": self.config.get("judge_relevance", 0.25),
-            "willingness": self.config.get("judge_willingness", 0.2),
-            "social": self.config.get("judge_social", 0.2),
-            "timing": self.config.get("judge_timing", 0.15),
-            "continuity": self.config.get("judge_continuity", 0.2)
+        # 判断权重配置（已归一化），以及综合评分用的权重元组
+        self.weights, self._judge_weight_vec = self._init_judge_weights()
+
+        # 状态报告中只依赖配置的字段，初始化时计算一次
+        self._status_static_fields = {
+            "reply_threshold": self.reply_threshold,
+            "judge_provider_name": self.judge_provider_name,
+            "whitelist_mode": '开启' if self.whitelist_enabled else '关闭',
+            "whitelist_count": len(self.chat_whitelist) if self.whitelist_enabled else 0,
+            "max_buffer_size": self.max_buffer_size,
+            **{f"weight_{k}": v for k, v in self.weights.items()}
         }
-        # 检查权重和
-        weight_sum = sum(self.weights.values())
-        if abs(weight_sum - 1.0) > 1e-6:
-            logger.warning(f"判断权重和不为1，当前和为{weight_sum}")
-            # 进行归一化处理
-            self.weights = {k: v / weight_sum for k, v in self.weights.items()}
-            logger.info(f"判断权重和已归一化，当前配置为: {self.weights}")
 
         # 加载好感度数据
         if self.enable_favorability:
@@ -212,13 +446,13 @@ class HeartflowPlugin(star.Star):
         """获取或创建精简版系统提示词"""
         try:
             # 获取当前会话ID
-            curr_cid = await self.context.conversation_manager.get_curr_conversation_id(event.unified_msg_origin)
+            curr_cid, has_conversation, persona_id = await self._get_conversation_meta(event.unified_msg_origin)
             if not curr_cid:
                 return original_prompt
             
             # 获取当前人格ID作为缓存键的一部分
-            conversation = await self.context.conversation_manager.get_conversation(event.unified_msg_origin, curr_cid)
-            persona_id = conversation.persona_id if conversation else "default"
+            if not has_conversation:
+                persona_id = "default"
             
             # 构建缓存键
             cache_key = f"{curr_cid}_{persona_id}"
@@ -226,9 +460,10 @@ class HeartflowPlugin(star.Star):
             # 检查缓存
             if cache_key in self.system_prompt_cache:
                 cached = self.system_prompt_cache[cache_key]
+                self.system_prompt_cache.move_to_end(cache_key)
                 # 如果原始提示词没有变化，返回缓存的总结
                 if cached.get("original") == original_prompt:
-                    logger.debug(f"使用缓存的精简系统提示词: {cache_key}")
+                    logger.debug("使用缓存的精简系统提示词: %s", cache_key)
                     return cached.get("summarized", original_prompt)
             
             # 如果没有缓存或原始提示词发生变化，进行总结
@@ -236,7 +471,28 @@ class HeartflowPlugin(star.Star):
                 # 如果原始提示词太短，直接返回
                 return original_prompt
             
-            summarized_prompt = await self._summarize_system_prompt(original_prompt)
+            # 先查持久化缓存，命中则无需调用小模型
+            prompt_hash = self._hash_prompt(
+                self._summarize_prompt_head + original_prompt + self._summarize_prompt_tail
+            )
+            summarized_prompt = self.summary_cache.get(prompt_hash)
+            if summarized_prompt is not None:
+                self.summary_cache.move_to_end(prompt_hash)
+            else:
+                task = self._summarize_inflight.get(prompt_hash)
+                if task is None:
+                    task = asyncio.ensure_future(self._summarize_system_prompt(original_prompt))
+                    self._summarize_inflight[prompt_hash] = task
+                    task.add_done_callback(lambda _: self._summarize_inflight.pop(prompt_hash, None))
+                # shield：某个等待者被取消时不影响其他共享该任务的请求
+                summarized_prompt = await asyncio.shield(task)
+                # 总结失败时会返回原始提示词，此时不写入持久化缓存，下次重试
+                if summarized_prompt != original_prompt:
+                    self.summary_cache[prompt_hash] = summarized_prompt
+                    self.summary_cache.move_to_end(prompt_hash)
+                    while len(self.summary_cache) > self._summary_cache_max:
+                        self.summary_cache.popitem(last=False)
+                    self._summary_cache_dirty = True
             
             # 更新缓存
             self.system_prompt_cache[cache_key] = {
@@ -244,6 +500,9 @@ class HeartflowPlugin(star.Star):
                 "summarized": summarized_prompt,
                 "persona_id": persona_id
             }
+            self.system_prompt_cache.move_to_end(cache_key)
+            while len(self.system_prompt_cache) > self.max_prompt_cache:
+                self.system_prompt_cache.popitem(last=False)
             
             logger.info(f"创建新的精简系统提示词: {cache_key} | 原长度:{len(original_prompt)} -> 新长度:{len(summarized_prompt)}")
             return summarized_prompt
@@ -252,6 +511,68 @@ class HeartflowPlugin(star.Star):
             logger.error(f"获取精简系统提示词失败: {e}")
             return original_prompt
     
+    def _init_judge_weights(self) -> tuple:
+        """读取判断权重配置，必要时归一化
+
+        Returns:
+            (权重字典, 权重元组)，元组顺序为 (相关度, 意愿, 社交, 时机, 连贯性)
+        """
+        weights = {
+            "relevance": self.config.get("judge_relevance", 0.25),
+            "willingness": self.config.get("judge_willingness", 0.2),
+            "social": self.config.get("judge_social", 0.2),
+            "timing": self.config.get("judge_timing", 0.15),
+            "continuity": self.config.get("judge_continuity", 0.2)
+        }
+        # 检查权重和，仅在不为1时才重建字典
+        weight_sum = sum(weights.values())
+        if abs(weight_sum - 1.0) > 1e-6:
+            logger.warning(f"判断权重和不为1，当前和为{weight_sum}")
+            # 进行归一化处理
+            weights = {k: v / weight_sum for k, v in weights.items()}
+            logger.info(f"判断权重和已归一化，当前配置为: {weights}")
+
+        weight_vec = (
+            weights["relevance"],
+            weights["willingness"],
+            weights["social"],
+            weights["timing"],
+            weights["continuity"]
+        )
+        return weights, weight_vec
+
+    def _hash_prompt(self, prompt: str) -> str:
+        """计算提示词内容哈希，作为持久化缓存键（调用方传入完整的总结请求文本）"""
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+    def _load_summary_cache(self):
+        """从文件加载精简提示词缓存"""
+        if not self.summary_cache_file.exists():
+            return
+        
+        try:
+            # 文件按使用先后顺序保存，超出上限时只保留最近的条目
+            summaries = _json_load_file(self.summary_cache_file).get("summaries", {})
+            self.summary_cache = OrderedDict(islice(summaries.items(), max(0, len(summaries) - self._summary_cache_max), None))
+            if len(self.summary_cache) < len(summaries):
+                self._summary_cache_dirty = True
+            logger.info(f"精简提示词缓存已加载，共{len(self.summary_cache)}条")
+        except Exception as e:
+            logger.error(f"加载精简提示词缓存失败: {e}")
+            self.summary_cache = OrderedDict()
+    
+    def _save_summary_cache(self):
+        """保存精简提示词缓存到文件（仅在有变更时写入）"""
+        if not self.summary_cache_file or not self._summary_cache_dirty:
+            return
+        
+        try:
+            self._ensure_data_dir()
+            _json_dump_file(self.summary_cache_file, {"summaries": self.summary_cache})
+            self._summary_cache_dirty = False
+        except Exception as e:
+            logger.error("保存精简提示词缓存失败: %s", e)
+
     async def _summarize_system_prompt(self, original_prompt: str) -> str:
         """使用小模型对系统提示词进行总结"""
         try:
@@ -262,23 +583,7 @@ class HeartflowPlugin(star.Star):
             if not judge_provider:
                 return original_prompt
             
-            # 使用配置的总结指令，如果没有配置则使用默认指令
-            if self.summarize_instruction:
-                instruction = self.summarize_instruction
-            else:
-                instruction = "请将以下机器人角色设定总结为简洁的核心要点，保留关键的性格特征、行为方式和角色定位。总结后的内容应该在100-200字以内，突出最重要的角色特点。"
-            
-            summarize_prompt = f"""{instruction}
-
-原始角色设定：
-{original_prompt}
-
-请以JSON格式回复：
-{{
-    "summarized_persona": "精简后的角色设定，保留核心特征和行为方式"
-}}
-
-重要：你的回复必须是完整的JSON对象，不要包含任何其他内容！"""
+            summarize_prompt = self._summarize_prompt_head + original_prompt + self._summarize_prompt_tail
 
             llm_response = await judge_provider.text_chat(
                 prompt=summarize_prompt,
@@ -289,12 +594,7 @@ class HeartflowPlugin(star.Star):
             
             # 尝试提取JSON
             try:
-                if content.startswith("```json"):
-                    content = content.replace("```json", "").replace("```", "").strip()
-                elif content.startswith("```"):
-                    content = content.replace("```", "").strip()
-
-                result_data = json.loads(content)
+                result_data = self._parse_json_response(content)
                 summarized = result_data.get("summarized_persona", "")
                 
                 if summarized and len(summarized.strip()) > 10:
@@ -311,48 +611,8 @@ class HeartflowPlugin(star.Star):
             logger.error(f"总结系统提示词异常: {e}")
             return original_prompt
 
-    async def judge_with_tiny_model(self, event: AstrMessageEvent) -> JudgeResult:
-        """使用小模型进行智能判断"""
-        
-        session_id = event.unified_msg_origin
-        
-        # 标记开始判断（用于过滤小模型回复）
-        self.judging_sessions.add(session_id)
-        
-        try:
-            return await self._do_judge(event)
-        finally:
-            # 判断结束，移除标记
-            self.judging_sessions.discard(session_id)
-    
-    async def _do_judge(self, event: AstrMessageEvent) -> JudgeResult:
-        """执行判断的内部方法"""
-
-        if not self.judge_provider_name:
-            logger.warning("小参数判断模型提供商名称未配置，跳过心流判断")
-            return JudgeResult(should_reply=False, reasoning="提供商未配置")
-
-        # 获取指定的 provider
-        try:
-            judge_provider = self.context.get_provider_by_id(self.judge_provider_name)
-            if not judge_provider:
-                logger.warning(f"未找到提供商: {self.judge_provider_name}")
-                return JudgeResult(should_reply=False, reasoning=f"提供商不存在: {self.judge_provider_name}")
-        except Exception as e:
-            logger.error(f"获取提供商失败: {e}")
-            return JudgeResult(should_reply=False, reasoning=f"获取提供商失败: {str(e)}")
-
-        # 获取群聊状态
-        chat_state = self._get_chat_state(event.unified_msg_origin)
-
-        # 获取当前对话的人格系统提示词，让模型了解大参数LLM的角色设定
-        original_persona_prompt = await self._get_persona_system_prompt(event)
-        logger.debug(f"小参数模型获取原始人格提示词: {'有' if original_persona_prompt else '无'} | 长度: {len(original_persona_prompt) if original_persona_prompt else 0}")
-        
-        # 获取或创建精简版系统提示词
-        persona_system_prompt = await self._get_or_create_summarized_system_prompt(event, original_persona_prompt)
-        logger.debug(f"小参数模型使用精简人格提示词: {'有' if persona_system_prompt else '无'} | 长度: {len(persona_system_prompt) if persona_system_prompt else 0}")
-
+    def _build_judge_rules_prompt(self) -> str:
+        """构建判断提示词中只依赖配置的静态部分（评估规则、阈值、拉黑规则、JSON格式）"""
         reasoning_part = ""
         if self.judge_include_reasoning:
             reasoning_part = ',\n    "reasoning": "详细分析原因，说明为什么应该或不应该回复，需要结合机器人角色特点进行分析，特别说明与上次回复的关联性"'
@@ -387,43 +647,7 @@ class HeartflowPlugin(star.Star):
    - 如果当前消息与我上次回复无关，给中等分数
    - 如果对话历史中没有我的回复记录，给低分"""
 
-        # 获取好感度信息
-        user_id = event.get_sender_id()
-        user_fav = self._get_user_favorability(event.unified_msg_origin, user_id)
-        
-        # 好感度描述
-        fav_info = ""
-        if self.enable_favorability:
-            level, emoji = self._get_favorability_level(user_fav)
-            fav_info = f"\n对当前用户的好感度: {user_fav:.0f}/100 ({level} {emoji})"
-        
-        # 构建完整的判断提示词
-        judge_prompt = f"""
-你是群聊机器人的决策系统，需要判断是否应该主动回复以下消息。
-
-重要说明：
-- 对话历史已提供给你，你可以查看完整的对话流程
-- [群友消息] = 群友发送的消息
-- [我的回复] = 机器人（我）发送的回复
-
-机器人角色设定:
-{persona_system_prompt if persona_system_prompt else "默认角色：智能助手"}
-
-当前群聊ID:
-{event.unified_msg_origin}
-
-机器人状态:
-我的精力水平: {chat_state.energy:.1f}/1.0
-最近活跃度: {'高' if chat_state.total_messages > 100 else '中' if chat_state.total_messages > 20 else '低'}
-上次发言: {self._get_minutes_since_last_reply(event.unified_msg_origin)}分钟前
-历史回复率: {(chat_state.total_replies / max(1, chat_state.total_messages) * 100):.1f}%{fav_info}
-
-待判断消息:
-发送者: {event.get_sender_name()}
-内容: {event.message_str}
-时间: {datetime.datetime.now().strftime('%H:%M:%S')}
-
-{evaluation_rules}
+        return f"""{evaluation_rules}
 
 回复阈值: {self.reply_threshold} (综合评分达到此分数才回复)
 
@@ -445,6 +669,248 @@ class HeartflowPlugin(star.Star):
 }}
 
 注意：你的回复必须是完整的JSON对象，不要包含任何解释性文字或其他内容！
+"""
+
+    def _get_judge_prompt_prefix(self, persona_system_prompt: str) -> str:
+        """获取判断提示词的静态前缀，按人格提示词缓存"""
+        prefix = self._judge_prefix_cache.get(persona_system_prompt)
+        if prefix is not None:
+            return prefix
+
+        prefix = "你是一个专业的群聊回复决策系统，能够准确判断消息价值和回复时机。"
+        if persona_system_prompt:
+            prefix += f"\n\n你正在为以下角色的机器人做决策：\n{persona_system_prompt}"
+        prefix += "\n\n重要提醒：你必须严格按照JSON格式返回结果，不要包含任何其他内容！请不要进行对话，只返回JSON！\n\n"
+        prefix += f"""
+你是群聊机器人的决策系统，需要判断是否应该主动回复以下消息。
+
+重要说明：
+- 对话历史已提供给你，你可以查看完整的对话流程
+- [群友消息] = 群友发送的消息
+- [我的回复] = 机器人（我）发送的回复
+
+机器人角色设定:
+{persona_system_prompt if persona_system_prompt else "默认角色：智能助手"}
+
+{self._judge_rules_prompt}"""
+
+        self._judge_prefix_cache[persona_system_prompt] = prefix
+        return prefix
+
+    def _parse_json_response(self, content: str) -> dict:
+        """解析小模型返回的JSON，直接解析失败时依次尝试去除代码块标记、提取被说明文字包裹的JSON对象"""
+        # 大多数回复是干净的JSON，先直接解析，省去预处理
+        try:
+            return _json_loads(content)
+        except json.JSONDecodeError:
+            pass
+
+        content = _strip_json_fence(content)
+        try:
+            return _json_loads(content)
+        except json.JSONDecodeError:
+            # 小模型常在JSON前后附带解释文字，提取其中的JSON对象再解析一次
+            match = _JSON_OBJECT_RE.search(content)
+            if not match:
+                raise
+            return _json_loads(match.group())
+
+    def _build_judge_result(self, judge_data: dict, user_fav: float) -> JudgeResult:
+        """根据小模型返回的评分计算综合评分，并结合好感度概率决定是否回复"""
+        # 直接从JSON根对象获取分数
+        relevance = judge_data.get("relevance", 0)
+        willingness = judge_data.get("willingness", 0)
+        social = judge_data.get("social", 0)
+        timing = judge_data.get("timing", 0)
+        continuity = judge_data.get("continuity", 0)
+        
+        # 计算综合评分（分数为0-10，乘0.1归一化）
+        w = self._judge_weight_vec
+        overall_score = (
+            relevance * w[0] +
+            willingness * w[1] +
+            social * w[2] +
+            timing * w[3] +
+            continuity * w[4]
+        ) * 0.1
+
+        # 首先判断是否达到基础阈值
+        meets_threshold = overall_score >= self.reply_threshold
+        
+        # 如果达到阈值，再根据好感度概率性决定是否回复
+        should_reply = False
+        reply_probability = 1.0
+        random_roll = 0.0
+        
+        if meets_threshold:
+            reply_probability = self._calculate_reply_probability(user_fav)
+            random_roll = self._rng.random()
+            should_reply = random_roll <= reply_probability
+        
+        if self.enable_favorability:
+            logger.debug("好感度概率判定: 好感度=%.0f | 概率=%.2f%% | 随机数=%.3f | 结果=%s",
+                         user_fav, reply_probability * 100, random_roll, '通过' if should_reply else '未通过')
+        else:
+            logger.debug("未达到基础阈值 %.2f，不回复", self.reply_threshold)
+
+        return JudgeResult(
+            relevance=relevance,
+            willingness=willingness,
+            social=social,
+            timing=timing,
+            continuity=continuity,
+            reasoning=judge_data.get("reasoning", "") if self.judge_include_reasoning else "",
+            should_reply=should_reply,
+            confidence=overall_score,  # 使用综合评分作为置信度
+            overall_score=overall_score,
+            related_messages=[],  # 不再使用关联消息功能
+            blacklist=judge_data.get("blacklist", "")  # 新增：拉黑动作
+        )
+
+    async def judge_with_tiny_model(self, event: AstrMessageEvent, chat_state: Optional[ChatState] = None,
+                                    is_media: Optional[bool] = None) -> JudgeResult:
+        """使用小模型进行智能判断（chat_state、is_media 为调用方已获取的群聊状态和媒体识别结果）"""
+        
+        session_id = event.unified_msg_origin
+        
+        # 标记开始判断（用于过滤小模型回复）
+        self.judging_sessions.add(session_id)
+        
+        try:
+            return await self._do_judge(event, chat_state, is_media)
+        finally:
+            # 判断结束，移除标记
+            self.judging_sessions.discard(session_id)
+    
+    async def _judge_latest_message(self, event: AstrMessageEvent, chat_state: Optional[ChatState] = None,
+                                    is_media: Optional[bool] = None) -> Optional[JudgeResult]:
+        """按群聊合并判断：等待进行中的判断完成后，只有最新到达的消息继续判断
+
+        Bot 每次最多回复一条，突发消息逐条判断只会浪费小模型调用。
+        被后续消息取代时返回 None；最新的消息在等待期间被取消时，由仍在等待的最新一条接替判断。
+        """
+        chat_id = event.unified_msg_origin
+        seq = self._judge_seq.get(chat_id, 0) + 1
+        self._judge_seq[chat_id] = seq
+        waiting = self._judge_waiting.setdefault(chat_id, [])
+        waiting.append(seq)
+
+        try:
+            while (inflight := self._judge_inflight.get(chat_id)) is not None:
+                await inflight.wait()
+            # 只与仍在等待的消息比较：被取消的消息已在 finally 中移出列表，不会让整批消息都放弃判断
+            if waiting[-1] != seq:
+                return None
+        finally:
+            waiting.remove(seq)
+            if not waiting:
+                del self._judge_waiting[chat_id]
+        # 检查与登记之间没有 await，保证同一群聊只有一个判断在进行
+        done = asyncio.Event()
+        self._judge_inflight[chat_id] = done
+        try:
+            return await self.judge_with_tiny_model(event, chat_state, is_media)
+        finally:
+            del self._judge_inflight[chat_id]
+            done.set()
+
+    async def _do_judge(self, event: AstrMessageEvent, chat_state: Optional[ChatState] = None,
+                        is_media: Optional[bool] = None) -> JudgeResult:
+        """执行判断的内部方法"""
+
+        if not self.judge_provider_name:
+            logger.warning("小参数判断模型提供商名称未配置，跳过心流判断")
+            return JudgeResult(should_reply=False, reasoning="提供商未配置")
+
+        # 获取指定的 provider
+        try:
+            judge_provider = self.context.get_provider_by_id(self.judge_provider_name)
+            if not judge_provider:
+                logger.warning(f"未找到提供商: {self.judge_provider_name}")
+                return JudgeResult(should_reply=False, reasoning=f"提供商不存在: {self.judge_provider_name}")
+        except Exception as e:
+            logger.error(f"获取提供商失败: {e}")
+            return JudgeResult(should_reply=False, reasoning=f"获取提供商失败: {str(e)}")
+
+        # 获取群聊状态
+        chat_id = event.unified_msg_origin
+        if chat_state is None:
+            chat_state = self._get_chat_state(chat_id)
+        minutes_since_reply = self._get_minutes_since_last_reply(chat_id, chat_state)
+
+        # 获取好感度信息
+        user_id = event.get_sender_id()
+        user_fav = self._get_user_favorability(chat_id, user_id, chat_state)
+        fav_level, fav_emoji = self._get_favorability_level(user_fav)
+
+        # 检查判断缓存（仅缓存纯文本消息，媒体消息内容不同但文本可能相同）
+        now = time.monotonic()
+        message_text = event.message_str.strip()
+        judge_cache_key = None
+        persona_id = None
+        if is_media is None:
+            is_media = self._get_media_type(event) != "unknown"
+        cacheable = bool(message_text) and not is_media
+        if cacheable:
+            # 人格ID来自会话元信息缓存，通常不会访问会话管理器；获取失败时本次不使用缓存
+            try:
+                _, _, persona_id = await self._get_conversation_meta(chat_id)
+            except Exception as e:
+                logger.debug("获取会话元信息失败，跳过判断缓存: %s", e)
+                cacheable = False
+        if cacheable:
+            judge_cache_key = (
+                chat_id,
+                user_id,
+                persona_id,
+                # 评分依赖最近上下文（相关度、连贯性），上下文有新消息或机器人回复后不再复用
+                self._judge_context_signature(
+                    chat_id, f"[User ID: {user_id}, Nickname: {event.get_sender_name()}]\n{event.message_str}"),
+                # 忽略大小写和多余空白，"OK"/"ok " 视为同一条消息
+                " ".join(message_text.lower().split()),
+                round(chat_state.energy, 1),
+                # 超过30分钟未发言对评分影响相同，归为同一档
+                min(minutes_since_reply, 30) // 5,
+                fav_level if self.enable_favorability else ""
+            )
+            cached = self._judge_cache.get(judge_cache_key)
+            if cached is not None and now - cached[0] < self._judge_cache_ttl:
+                self._judge_cache.move_to_end(judge_cache_key)
+                logger.debug("命中判断缓存，复用评分: %.30s", message_text)
+                return self._build_judge_result(cached[1], user_fav)
+
+        # 获取当前对话的人格系统提示词，让模型了解大参数LLM的角色设定
+        original_persona_prompt = await self._get_persona_system_prompt(event)
+        logger.debug("小参数模型获取原始人格提示词: %s | 长度: %d",
+                     '有' if original_persona_prompt else '无', len(original_persona_prompt) if original_persona_prompt else 0)
+        
+        # 获取或创建精简版系统提示词
+        persona_system_prompt = await self._get_or_create_summarized_system_prompt(event, original_persona_prompt)
+        logger.debug("小参数模型使用精简人格提示词: %s | 长度: %d",
+                     '有' if persona_system_prompt else '无', len(persona_system_prompt) if persona_system_prompt else 0)
+
+        # 好感度描述
+        fav_info = ""
+        if self.enable_favorability:
+            fav_info = f"\n对当前用户的好感度: {user_fav:.0f}/100 ({fav_level} {fav_emoji})"
+        
+        # 动态部分作为用户提示词，位于对话历史之后；静态前缀另作系统提示词发送
+        judge_prompt = f"""
+当前群聊ID:
+{chat_id}
+
+机器人状态:
+我的精力水平: {chat_state.energy:.1f}/1.0
+最近活跃度: {'高' if chat_state.total_messages > 100 else '中' if chat_state.total_messages > 20 else '低'}
+上次发言: {minutes_since_reply}分钟前
+历史回复率: {(chat_state.total_replies / max(1, chat_state.total_messages) * 100):.1f}%{fav_info}
+
+待判断消息:
+发送者: {event.get_sender_name()}
+内容: {event.message_str}
+时间: {self._get_current_time_str()}
+
+请根据以上信息评估，只返回JSON对象。
 """
 
         try:
@@ -452,79 +918,32 @@ class HeartflowPlugin(star.Star):
             # 小模型判断需要添加标注来帮助理解对话角色
             recent_contexts = await self._get_recent_contexts(event, add_labels=True)
 
-            # 构建完整的判断提示词，将系统提示直接整合到prompt中
-            complete_judge_prompt = "你是一个专业的群聊回复决策系统，能够准确判断消息价值和回复时机。"
-            if persona_system_prompt:
-                complete_judge_prompt += f"\n\n你正在为以下角色的机器人做决策：\n{persona_system_prompt}"
-            complete_judge_prompt += "\n\n重要提醒：你必须严格按照JSON格式返回结果，不要包含任何其他内容！请不要进行对话，只返回JSON！\n\n"
-            complete_judge_prompt += judge_prompt
+            # 静态前缀（系统说明+人格+评估规则）作为系统提示词，请求顺序为：系统提示词 → 对话历史 → 动态尾部
+            judge_system_prompt = self._get_judge_prompt_prefix(persona_system_prompt)
 
             try:
                 logger.debug("小参数模型判断尝试")
                 
-                llm_response = await judge_provider.text_chat(
-                    prompt=complete_judge_prompt,
-                    contexts=recent_contexts  # 传入最近的对话历史
-                )
+                async with self._judge_semaphore:
+                    llm_response = await judge_provider.text_chat(
+                        prompt=judge_prompt,
+                        contexts=recent_contexts,  # 传入最近的对话历史
+                        system_prompt=judge_system_prompt
+                    )
 
                 content = llm_response.completion_text.strip()
-                logger.debug(f"小参数模型原始返回内容: {content[:200]}...")
+                logger.debug("小参数模型原始返回内容: %.200s...", content)
 
                 # 尝试提取JSON
-                if content.startswith("```json"):
-                    content = content.replace("```json", "").replace("```", "").strip()
-                elif content.startswith("```"):
-                    content = content.replace("```", "").strip()
-
-                judge_data = json.loads(content)
-
-                # 直接从JSON根对象获取分数
-                relevance = judge_data.get("relevance", 0)
-                willingness = judge_data.get("willingness", 0)
-                social = judge_data.get("social", 0)
-                timing = judge_data.get("timing", 0)
-                continuity = judge_data.get("continuity", 0)
-                
-                # 计算综合评分
-                overall_score = (
-                    relevance * self.weights["relevance"] +
-                    willingness * self.weights["willingness"] +
-                    social * self.weights["social"] +
-                    timing * self.weights["timing"] +
-                    continuity * self.weights["continuity"]
-                ) / 10.0
-
-                # 首先判断是否达到基础阈值
-                meets_threshold = overall_score >= self.reply_threshold
-                
-                # 如果达到阈值，再根据好感度概率性决定是否回复
-                should_reply = False
-                reply_probability = 1.0
-                random_roll = 0.0
-                
-                if meets_threshold:
-                    reply_probability = self._calculate_reply_probability(user_fav)
-                    random_roll = random.random()
-                    should_reply = random_roll <= reply_probability
-                
-                if self.enable_favorability:
-                    logger.debug(f"好感度概率判定: 好感度={user_fav:.0f} | 概率={reply_probability:.2%} | 随机数={random_roll:.3f} | 结果={'通过' if should_reply else '未通过'}")
-                else:
-                    logger.debug(f"未达到基础阈值 {self.reply_threshold:.2f}，不回复")
-
-                return JudgeResult(
-                    relevance=relevance,
-                    willingness=willingness,
-                    social=social,
-                    timing=timing,
-                    continuity=continuity,
-                    reasoning=judge_data.get("reasoning", "") if self.judge_include_reasoning else "",
-                    should_reply=should_reply,
-                    confidence=overall_score,  # 使用综合评分作为置信度
-                    overall_score=overall_score,
-                    related_messages=[],  # 不再使用关联消息功能
-                    blacklist=judge_data.get("blacklist", "")  # 新增：拉黑动作
-                )
+                judge_data = self._parse_json_response(content)
+
+                # 缓存评分；带拉黑动作的结果针对特定用户，不复用
+                if judge_cache_key is not None and not judge_data.get("blacklist"):
+                    self._judge_cache[judge_cache_key] = (now, judge_data)
+                    while len(self._judge_cache) > self._judge_cache_max:
+                        self._judge_cache.popitem(last=False)
+
+                return self._build_judge_result(judge_data, user_fav)
                 
             except json.JSONDecodeError as e:
                 logger.error(f"小参数模型返回JSON解析失败: {str(e)}")
@@ -540,21 +959,28 @@ class HeartflowPlugin(star.Star):
         """群聊消息入口：检查过滤→记录消息→心流判断→设置唤醒标志"""
         
         # 基础检查：启用状态、白名单、非空消息
-        if not self.config.get("enable_heartflow", False):
+        if not self.enable_heartflow:
             return
         
+        # 群聊ID和用户ID会作为多个字典的键反复出现，驻留后字典查找可直接比较对象身份
+        # 部分适配器返回非字符串ID（如 int），sys.intern 只接受 str，此时保持原值
+        chat_id = event.unified_msg_origin
+        if isinstance(chat_id, str):
+            chat_id = sys.intern(chat_id)
         if self.whitelist_enabled:
-            if not self.chat_whitelist or event.unified_msg_origin not in self.chat_whitelist:
-                logger.debug(f"群聊不在白名单中，跳过处理: {event.unified_msg_origin}")
+            if not self.chat_whitelist or chat_id not in self._whitelist_set:
+                logger.debug("群聊不在白名单中，跳过处理: %s", chat_id)
                 return
         
-        if event.get_sender_id() == event.get_self_id():
+        user_id = event.get_sender_id()
+        if isinstance(user_id, str):
+            user_id = sys.intern(user_id)
+        if user_id == event.get_self_id():
             return
         
         # 检查用户是否被拉黑
-        user_id = event.get_sender_id()
         if self._is_user_blacklisted(user_id):
-            logger.debug(f"用户 {user_id} 已被拉黑，跳过处理")
+            logger.debug("用户 %s 已被拉黑，跳过处理", user_id)
             return
         
         # 获取媒体类型，如果不是unknown则认为是媒体消息
@@ -562,124 +988,133 @@ class HeartflowPlugin(star.Star):
         is_media = media_type != "unknown"
         
         # 获取用户信息（媒体和文本消息都需要）
-        user_id = event.get_sender_id()
         user_name = event.get_sender_name()
+        # 本条消息的时间戳，记录消息和更新回复状态共用
+        now = time.time()
         
         # 处理媒体消息
         if is_media:
             if self.enable_media_recognition:
+                media_label = self._get_media_label(media_type)
                 # 识别媒体内容
                 recognized_content = await self._recognize_media_content(event)
                 if recognized_content:
                     # 识别成功，记录包含识别结果的消息
-                    media_label = self._get_media_label(media_type)
                     message_content = f"[User ID: {user_id}, Nickname: {user_name}]\n[{media_label}] {recognized_content}"
-                    self._record_message(event.unified_msg_origin, "user", message_content)
-                    logger.debug(f"✏️ 媒体消息已记录并识别 | {recognized_content[:30]}...")
+                    self._record_message(chat_id, "user", message_content, now)
+                    logger.debug("✏️ 媒体消息已记录并识别 | %.30s...", recognized_content)
                 elif recognized_content == "":
                     # GIF文件等跳过处理的媒体，完全跳过
-                    logger.debug(f"✏️ 媒体消息已跳过（GIF等）| {event.message_str[:30]}...")
+                    logger.debug("✏️ 媒体消息已跳过（GIF等）| %.30s...", event.message_str)
                     return
                 else:
                     # 识别失败，只记录原始消息
-                    media_label = self._get_media_label(media_type)
                     message_content = f"[User ID: {user_id}, Nickname: {user_name}]\n[{media_label}]"
-                    self._record_message(event.unified_msg_origin, "user", message_content)
-                    logger.debug(f"✏️ 媒体消息已记录（识别失败）| {media_label[:30]}...")
+                    self._record_message(chat_id, "user", message_content, now)
+                    logger.debug("✏️ 媒体消息已记录（识别失败）| %.30s...", media_label)
             else:
                 # 未启用识别，完全跳过媒体消息
-                logger.debug(f"✏️ 媒体消息已跳过（未启用识别）| {event.message_str[:30]}...")
+                logger.debug("✏️ 媒体消息已跳过（未启用识别）| %.30s...", event.message_str)
                 return
         
         # 处理文本消息（非媒体消息）
         if not is_media:
             # 检查消息内容是否为空（跳过QQ表情等空消息）
             if not event.message_str or not event.message_str.strip():
-                logger.debug(f"✏️ 跳过空消息 | {event.message_str[:30]}...")
+                logger.debug("✏️ 跳过空消息 | %.30s...", event.message_str)
                 return
             
             # 通过基础检查后，记录用户消息到缓冲区（包括@消息）
             message_content = f"[User ID: {user_id}, Nickname: {user_name}]\n{event.message_str}"
-            self._record_message(event.unified_msg_origin, "user", message_content)
-            logger.debug(f"✏️ 用户消息已记录 | {event.message_str[:30]}...")
+            self._record_message(chat_id, "user", message_content, now)
+            logger.debug("✏️ 用户消息已记录 | %.30s...", event.message_str)
         
         # 检查是否需要心流判断（@消息跳过判断，但已经被记录）
         if event.is_at_or_wake_command:
             # 检查@消息的用户是否被拉黑
-            user_id = event.get_sender_id()
             if self._is_user_blacklisted(user_id):
-                logger.debug(f"🚫 @消息用户被拉黑，不处理: {event.message_str[:30]}...")
+                logger.debug("🚫 @消息用户被拉黑，不处理: %.30s...", event.message_str)
                 return
             
-            logger.debug(f"跳过已被标记为唤醒的消息: {event.message_str[:30]}...")
+            logger.debug("跳过已被标记为唤醒的消息: %.30s...", event.message_str)
             
             # @消息增加好感度
-            if self.enable_favorability and (not self.whitelist_enabled or event.unified_msg_origin in self.chat_whitelist):
-                self._update_favorability(event.unified_msg_origin, user_id, 0.2)
-                self._record_interaction(event.unified_msg_origin, user_id)
-                logger.debug(f"@消息好感度 +0.2")
+            if self.enable_favorability and (not self.whitelist_enabled or chat_id in self._whitelist_set):
+                self._apply_interaction(chat_id, user_id, 0.2)
+                logger.debug("@消息好感度 +0.2")
             
             return
 
+        # 本条消息的群聊状态只获取一次，判断和状态更新共用
+        chat_state = self._get_chat_state(chat_id)
+
+        # 规则预过滤：明显无需回复的文本消息直接按不回复处理，不影响好感度
+        if not is_media and self.enable_judge_prefilter:
+            skip_reason = self._prefilter_judge(chat_id, user_id, event.message_str, now)
+            if skip_reason:
+                logger.debug("心流预过滤跳过判断 | 原因:%s", skip_reason)
+                await self._update_passive_state(event, JudgeResult(reasoning=f"预过滤：{skip_reason}"), chat_state)
+                return
+
         # 检查是否需要心流判断
         should_judge = True
         if is_media and not self.enable_media_judge:
             should_judge = False
-            logger.debug(f"媒体消息心流判断未启用，跳过判断")
+            logger.debug("媒体消息心流判断未启用，跳过判断")
         
         if should_judge:
             try:
-                judge_result = await self.judge_with_tiny_model(event)
+                if self.enable_judge_coalescing:
+                    judge_result = await self._judge_latest_message(event, chat_state, is_media)
+                    if judge_result is None:
+                        logger.debug("心流判断已合并到后续消息 | %.30s...", event.message_str)
+                        await self._update_passive_state(event, JudgeResult(reasoning="已合并到后续消息"), chat_state)
+                        return
+                else:
+                    judge_result = await self.judge_with_tiny_model(event, chat_state, is_media)
 
                 # 处理拉黑动作
                 if self.enable_blacklist and judge_result.blacklist:
-                    user_id = event.get_sender_id()
                     if judge_result.blacklist == "True":
                         self._blacklist_user(user_id)
                     elif judge_result.blacklist == "False":
                         self._unblacklist_user(user_id)
                 
                 # 检查用户是否被拉黑
-                user_id = event.get_sender_id()
                 is_blacklisted = self._is_user_blacklisted(user_id)
                 
                 if judge_result.should_reply and not is_blacklisted:
                     logger.info(f"❤️ 心流触发回复 | 评分:{judge_result.overall_score:.2f}")
                     event.is_at_or_wake_command = True
-                    self._update_active_state(event, judge_result)
+                    self._update_active_state(event, judge_result, now, chat_state)
                     
                     if self.enable_favorability:
                         fav_delta = self._calculate_favorability_change(judge_result, did_reply=True)
-                        self._update_favorability(event.unified_msg_origin, user_id, fav_delta)
-                        self._record_interaction(event.unified_msg_origin, user_id)
+                        self._apply_interaction(chat_id, user_id, fav_delta, chat_state)
                     
                     return
                     
                 elif judge_result.should_reply and is_blacklisted:
                     logger.info(f"🚫 心流触发但用户被拉黑，不回复 | 评分:{judge_result.overall_score:.2f}")
                     # 拉黑用户也会触发心流，但不回复，用于判断是否解封
-                    await self._update_passive_state(event, judge_result)
+                    await self._update_passive_state(event, judge_result, chat_state)
                     
                     if self.enable_favorability:
                         fav_delta = self._calculate_favorability_change(judge_result, did_reply=False)
-                        self._update_favorability(event.unified_msg_origin, user_id, fav_delta)
-                        self._record_interaction(event.unified_msg_origin, user_id)
+                        self._apply_interaction(chat_id, user_id, fav_delta, chat_state)
                     
                     return
                     
                 else:
-                    logger.debug(f"心流不回复 | 评分:{judge_result.overall_score:.2f}")
-                    await self._update_passive_state(event, judge_result)
+                    logger.debug("心流不回复 | 评分:%.2f", judge_result.overall_score)
+                    await self._update_passive_state(event, judge_result, chat_state)
                     
                     if self.enable_favorability:
                         fav_delta = self._calculate_favorability_change(judge_result, did_reply=False)
-                        self._update_favorability(event.unified_msg_origin, user_id, fav_delta)
-                        self._record_interaction(event.unified_msg_origin, user_id)
+                        self._apply_interaction(chat_id, user_id, fav_delta, chat_state)
 
             except Exception as e:
-                logger.error(f"心流插件处理消息异常: {e}")
-                import traceback
-                logger.error(traceback.format_exc())
+                logger.exception("心流插件处理消息异常: %s", e)
     
     @filter.on_llm_request(priority=-100)
     async def on_llm_req(self, event: AstrMessageEvent, req: ProviderRequest):
@@ -704,9 +1139,9 @@ class HeartflowPlugin(star.Star):
             # 过滤：小模型判断、未启用心流、不在白名单
             if chat_id in self.judging_sessions:
                 return
-            if not self.config.get("enable_heartflow", False):
+            if not self.enable_heartflow:
                 return
-            if self.whitelist_enabled and (not self.chat_whitelist or chat_id not in self.chat_whitelist):
+            if self.whitelist_enabled and (not self.chat_whitelist or chat_id not in self._whitelist_set):
                 return
             
             # === 检测AstrBot原生识图 ===
@@ -723,11 +1158,12 @@ class HeartflowPlugin(star.Star):
                 plugin_contexts = await self._get_recent_contexts(event, add_labels=False)
                 
                 if plugin_contexts:
-                    # 移除最后一条用户消息（避免与 prompt 重复）
-                    if plugin_contexts[-1].get("role") == "user":
-                        plugin_contexts = plugin_contexts[:-1]
+                    # 移除最后一条用户消息（避免与 prompt 重复）；列表为本次新建，可直接原地弹出
+                    if plugin_contexts[-1]["role"] == "user":
+                        plugin_contexts.pop()
 
-                    # 在消息列表开头插入好感度信息
+                    # 在消息列表末尾追加好感度信息（位于历史之后、本轮 prompt 之前），
+                    # 保持系统提示词和历史前缀稳定，便于服务端前缀缓存命中
                     if self.enable_favorability:
                         user_id = event.get_sender_id()
                         user_name = event.get_sender_name()
@@ -739,19 +1175,17 @@ class HeartflowPlugin(star.Star):
                         #     "content": f"（这是一条仅为你提供的内部状态更新，由系统自动插入。请根据此状态调整你的回复语气，但严禁在回复中向用户提及它。对{user_name}(ID:{user_id})的好感度: {fav:.0f}/100 {fav_level}，你只能回复这一个用户。）"
                         # })
 
-                        plugin_contexts.insert(0, {
+                        plugin_contexts.append({
                             "role": "user",
                             "content": f"（这是一条仅为你提供的内部状态更新，由系统自动插入。请根据此状态调整你的回复语气，但严禁向用户提及它。对最后一位用户的好感度: {fav_level}，你只能回复一位用户。）"
                         })
                     
                     # 替换对话历史
                     req.contexts = plugin_contexts
-                    logger.debug(f"✅ 已替换对话历史 | 消息数:{len(plugin_contexts)}")
+                    logger.debug("✅ 已替换对话历史 | 消息数:%d", len(plugin_contexts))
         
         except Exception as e:
-            logger.error(f"on_llm_request 钩子异常: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
+            logger.exception("on_llm_request 钩子异常: %s", e)
     
     @filter.on_llm_response(priority=100)
     async def on_llm_resp(self, event: AstrMessageEvent, resp: LLMResponse):
@@ -759,7 +1193,7 @@ class HeartflowPlugin(star.Star):
         
         过滤：小模型判断、非群聊消息、不在白名单
         """
-        if not self.config.get("enable_heartflow", False):
+        if not self.enable_heartflow:
             return
         
         try:
@@ -770,37 +1204,37 @@ class HeartflowPlugin(star.Star):
                 return
             if event.message_obj.type.name != "GROUP_MESSAGE":
                 return
-            if self.whitelist_enabled and (not self.chat_whitelist or chat_id not in self.chat_whitelist):
+            if self.whitelist_enabled and (not self.chat_whitelist or chat_id not in self._whitelist_set):
                 return
             
             # 记录机器人回复
             if resp.completion_text and resp.completion_text.strip():
                 self._record_message(chat_id, "assistant", resp.completion_text)
-                logger.debug(f"✏️ 机器人回复已记录: {resp.completion_text[:30]}...")
+                logger.debug("✏️ 机器人回复已记录: %.30s...", resp.completion_text)
         
         except Exception as e:
-            logger.debug(f"记录回复失败: {e}")
+            logger.debug("记录回复失败: %s", e)
 
     def _should_process_message(self, event: AstrMessageEvent) -> bool:
         """检查是否应该处理这条消息"""
 
         # 检查插件是否启用
-        if not self.config.get("enable_heartflow", False):
+        if not self.enable_heartflow:
             return False
 
         # 跳过已经被其他插件或系统标记为唤醒的消息
         if event.is_at_or_wake_command:
-            logger.debug(f"跳过已被标记为唤醒的消息: {event.message_str}")
+            logger.debug("跳过已被标记为唤醒的消息: %s", event.message_str)
             return False
 
         # 检查白名单
         if self.whitelist_enabled:
             if not self.chat_whitelist:
-                logger.debug(f"白名单为空，跳过处理: {event.unified_msg_origin}")
+                logger.debug("白名单为空，跳过处理: %s", event.unified_msg_origin)
                 return False
 
-            if event.unified_msg_origin not in self.chat_whitelist:
-                logger.debug(f"群聊不在白名单中，跳过处理: {event.unified_msg_origin}")
+            if event.unified_msg_origin not in self._whitelist_set:
+                logger.debug("群聊不在白名单中，跳过处理: %s", event.unified_msg_origin)
                 return False
 
         # 跳过机器人自己的消息
@@ -819,7 +1253,7 @@ class HeartflowPlugin(star.Star):
             self.chat_states[chat_id] = ChatState()
 
         # 检查日期重置
-        today = datetime.date.today().isoformat()
+        today = self._get_today()
         state = self.chat_states[chat_id]
 
         if state.last_reset_date != today:
@@ -834,9 +1268,26 @@ class HeartflowPlugin(star.Star):
 
         return state
 
-    def _get_minutes_since_last_reply(self, chat_id: str) -> int:
+    def _get_today(self) -> str:
+        """获取今日日期字符串（ISO格式），仅在跨过本地零点后重新计算"""
+        if time.time() >= self._today_expire:
+            today = datetime.date.today()
+            self._today_iso = today.isoformat()
+            # 下一个本地零点的时间戳（mktime会处理夏令时）
+            self._today_expire = time.mktime((today + datetime.timedelta(days=1)).timetuple())
+        return self._today_iso
+
+    def _get_current_time_str(self) -> str:
+        """获取当前时间字符串（HH:MM:SS），同一秒内复用缓存"""
+        now = int(time.time())
+        if now != self._time_str_cache[0]:
+            self._time_str_cache = (now, time.strftime('%H:%M:%S', time.localtime(now)))
+        return self._time_str_cache[1]
+
+    def _get_minutes_since_last_reply(self, chat_id: str, chat_state: Optional[ChatState] = None) -> int:
         """获取距离上次回复的分钟数"""
-        chat_state = self._get_chat_state(chat_id)
+        if chat_state is None:
+            chat_state = self._get_chat_state(chat_id)
 
         if chat_state.last_reply_time == 0:
             return 999  # 从未回复过
@@ -850,8 +1301,7 @@ class HeartflowPlugin(star.Star):
         try:
             # 加载群聊好感度
             if self.favorability_file.exists():
-                with open(self.favorability_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                data = _json_load_file(self.favorability_file)
                 
                 # 恢复数据到chat_states
                 for chat_id, chat_data in data.items():
@@ -869,8 +1319,7 @@ class HeartflowPlugin(star.Star):
             
             # 加载全局好感度
             if self.enable_global_favorability and self.global_favorability_file.exists():
-                with open(self.global_favorability_file, 'r', encoding='utf-8') as f:
-                    global_data = json.load(f)
+                global_data = _json_load_file(self.global_favorability_file)
                 
                 self.global_favorability = global_data.get("favorability", {})
                 self.global_interaction_count = global_data.get("interaction_count", {})
@@ -880,38 +1329,75 @@ class HeartflowPlugin(star.Star):
         except Exception as e:
             logger.error(f"加载好感度数据失败: {e}")
     
-    def _save_favorability(self):
-        """保存好感度数据到文件"""
-        try:
-            # 保存群聊好感度
-            data = {}
-            for chat_id, state in self.chat_states.items():
-                if state.user_favorability:  # 只保存有数据的群聊
-                    data[chat_id] = {
-                        "favorability": state.user_favorability,
-                        "interaction_count": state.user_interaction_count,
-                        "last_decay": state.last_favorability_decay
-                    }
-            
-            # 确保目录存在
-            self.favorability_file.parent.mkdir(parents=True, exist_ok=True)
-            
-            # 保存群聊好感度（静默保存，不输出日志）
-            with open(self.favorability_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            
-            # 保存全局好感度
-            if self.enable_global_favorability:
-                global_data = {
-                    "favorability": self.global_favorability,
-                    "interaction_count": self.global_interaction_count
+    def _snapshot_favorability(self) -> tuple:
+        """复制当前好感度数据，返回 (群聊数据, 全局数据或None)
+
+        在事件循环线程上调用，后台线程写文件期间好感度继续更新也不会互相影响
+        """
+        data = {}
+        for chat_id, state in self.chat_states.items():
+            if state.user_favorability:  # 只保存有数据的群聊
+                data[chat_id] = {
+                    "favorability": dict(state.user_favorability),
+                    "interaction_count": dict(state.user_interaction_count),
+                    "last_decay": state.last_favorability_decay
                 }
-                
-                with open(self.global_favorability_file, 'w', encoding='utf-8') as f:
-                    json.dump(global_data, f, ensure_ascii=False, indent=2)
+        
+        global_data = None
+        if self.enable_global_favorability:
+            global_data = {
+                "favorability": dict(self.global_favorability),
+                "interaction_count": dict(self.global_interaction_count)
+            }
+        return data, global_data
+    
+    def _count_favorability_stats(self) -> tuple:
+        """统计有好感度记录的群聊数和用户数，一次遍历完成"""
+        total_chats = 0
+        total_users = 0
+        for state in self.chat_states.values():
+            user_favorability = state.user_favorability
+            if user_favorability:
+                total_chats += 1
+                total_users += len(user_favorability)
+        return total_chats, total_users
+    
+    def _ensure_data_dir(self):
+        """确保插件数据目录存在（所有数据文件都位于该目录下），创建成功后跳过"""
+        if not self._data_dir_ready:
+            self.data_dir.mkdir(parents=True, exist_ok=True)
+            self._data_dir_ready = True
+
+    def _write_favorability(self, data: dict, global_data: Optional[dict]):
+        """将好感度快照写入文件（可在后台线程中执行）"""
+        # 确保目录存在
+        self._ensure_data_dir()
+        
+        # 保存群聊好感度（静默保存，不输出日志）
+        _json_dump_file(self.favorability_file, data)
+        
+        # 保存全局好感度（只有用户ID到数值的扁平映射，用紧凑格式缩小文件）
+        if global_data is not None:
+            _json_dump_file(self.global_favorability_file, global_data, indent=False)
+    
+    async def _save_favorability(self, force: bool = False):
+        """保存好感度数据到文件（默认仅在有变更时写入，force=True 时强制写入）
 
-        except Exception as e:
-            logger.error(f"保存好感度数据失败: {e}")
+        快照在事件循环线程上生成，文件写入放到后台线程，避免阻塞事件循环；
+        多次保存按顺序执行，后一次在前一次写完后再生成快照
+        """
+        async with self._favorability_save_lock:
+            if not force and not self._favorability_dirty:
+                return
+
+            snapshot = self._snapshot_favorability()
+            # 先清除标记，写入期间产生的新变更会重新标记
+            self._favorability_dirty = False
+            try:
+                await asyncio.to_thread(self._write_favorability, *snapshot)
+            except Exception as e:
+                self._favorability_dirty = True
+                logger.error("保存好感度数据失败: %s", e)
     
     def _load_blacklist(self):
         """从文件加载拉黑状态数据"""
@@ -920,10 +1406,9 @@ class HeartflowPlugin(star.Star):
             return
         
         try:
-            with open(self.blacklist_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                self.blacklist_system = data.get("blacklist_system", {})
-                
+            data = _json_load_file(self.blacklist_file)
+            self.blacklist_system = data.get("blacklist_system", {})
+
             blacklist_count = sum(1 for blacklisted in self.blacklist_system.values() if blacklisted)
             logger.info(f"已加载拉黑状态: {len(self.blacklist_system)}个用户记录, {blacklist_count}个被拉黑")
             
@@ -931,112 +1416,114 @@ class HeartflowPlugin(star.Star):
             logger.error(f"加载拉黑状态失败: {e}")
             self.blacklist_system = {}
     
-    def _save_blacklist(self):
-        """保存拉黑状态数据到文件"""
+    def _snapshot_blacklist(self) -> dict:
+        """复制当前拉黑状态（在事件循环线程上调用），后台线程写文件期间状态继续更新也不会互相影响"""
+        return {
+            "blacklist_system": dict(self.blacklist_system),
+            "save_time": time.time(),
+            "save_time_str": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        }
+    
+    def _write_blacklist(self, data: dict):
+        """将拉黑状态快照写入文件（可在后台线程中执行）"""
+        # 确保目录存在
+        self._ensure_data_dir()
+        _json_dump_file(self.blacklist_file, data)
+        
+        blacklist_system = data["blacklist_system"]
+        blacklist_count = sum(1 for blacklisted in blacklist_system.values() if blacklisted)
+        logger.info("拉黑状态已保存: %d个用户记录, %d个被拉黑", len(blacklist_system), blacklist_count)
+    
+    async def _save_blacklist(self) -> bool:
+        """保存拉黑状态数据到文件，返回是否保存成功
+
+        快照在事件循环线程上生成，文件写入放到后台线程；多次保存按顺序执行，避免并发写同一临时文件
+        """
         if not self.blacklist_file:
             logger.warning("拉黑状态文件路径未设置，跳过保存")
-            return
+            return True
         
-        try:
-            # 确保目录存在
-            self.blacklist_file.parent.mkdir(parents=True, exist_ok=True)
-            
-            # 构建保存数据
-            data = {
-                "blacklist_system": self.blacklist_system,
-                "save_time": time.time(),
-                "save_time_str": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-            }
-            
-            # 保存到文件
-            with open(self.blacklist_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            
-            blacklist_count = sum(1 for blacklisted in self.blacklist_system.values() if blacklisted)
-            logger.info(f"拉黑状态已保存: {len(self.blacklist_system)}个用户记录, {blacklist_count}个被拉黑")
-            
-        except Exception as e:
-            logger.error(f"保存拉黑状态失败: {e}")
+        async with self._blacklist_save_lock:
+            data = self._snapshot_blacklist()
+            # 先清除标记，写入期间产生的新变更会重新标记
+            self._blacklist_dirty = False
+            try:
+                await asyncio.to_thread(self._write_blacklist, data)
+                return True
+            except Exception as e:
+                self._blacklist_dirty = True
+                logger.error("保存拉黑状态失败: %s", e)
+                return False
     
+    def _schedule_blacklist_save(self):
+        """标记拉黑状态有变更，并在没有待执行的保存任务时启动一个"""
+        self._blacklist_dirty = True
+        if self._blacklist_save_task is None or self._blacklist_save_task.done():
+            self._blacklist_save_task = asyncio.ensure_future(self._flush_blacklist())
     
-    def _get_user_favorability(self, chat_id: str, user_id: str) -> float:
-        """获取用户好感度：优先全局（需启用+白名单），其次本地，新用户返回初始值"""
+    async def _flush_blacklist(self):
+        """延迟后保存拉黑状态，写入期间产生的新变更会再保存一次
+
+        _blacklist_flush_now 被设置时（插件卸载）跳过延迟立即保存；保存失败时停止，等待下次变更或卸载时重试
+        """
+        while self._blacklist_dirty:
+            try:
+                await asyncio.wait_for(self._blacklist_flush_now.wait(), timeout=self._blacklist_save_delay)
+            except asyncio.TimeoutError:
+                pass
+            if not await self._save_blacklist():
+                break
+    
+    def _global_allowed(self, chat_id: str) -> bool:
+        """该群聊是否使用全局好感度：需启用全局好感度，且启用白名单时群聊必须在白名单中"""
+        return self.enable_global_favorability and (not self.whitelist_enabled or chat_id in self._whitelist_set)
+
+    def _get_user_favorability(self, chat_id: str, user_id: str, chat_state: Optional[ChatState] = None) -> float:
+        """获取用户好感度：优先全局（需启用+白名单），其次本地，新用户返回初始值
+
+        已取得群聊状态的调用方可传入 chat_state，避免重复获取
+        """
         if not self.enable_favorability:
             return self.initial_favorability  # 系统未启用，返回初始值
         
-        # 检查是否使用全局好感度
-        use_global = self.enable_global_favorability
-        
-        # 如果启用了白名单，全局好感度也受白名单控制
-        if use_global and self.whitelist_enabled:
-            if not self.chat_whitelist or chat_id not in self.chat_whitelist:
-                use_global = False  # 不在白名单中，不使用全局好感度
-        
-        if use_global and user_id in self.global_favorability:
+        # 检查是否使用全局好感度（受白名单控制）
+        if self._global_allowed(chat_id) and user_id in self.global_favorability:
             return self.global_favorability[user_id]
         
         # 使用群聊本地好感度
-        chat_state = self._get_chat_state(chat_id)
+        if chat_state is None:
+            chat_state = self._get_chat_state(chat_id)
         return chat_state.user_favorability.get(user_id, self.initial_favorability)
     
-    def _get_user_interaction_count(self, chat_id: str, user_id: str) -> int:
-        """获取用户互动次数"""
+    def _get_user_fav_and_count(self, chat_id: str, user_id: str) -> tuple:
+        """同时获取用户好感度和本地互动次数，只获取一次群聊状态"""
         chat_state = self._get_chat_state(chat_id)
-        return chat_state.user_interaction_count.get(user_id, 0)
+        interaction_count = chat_state.user_interaction_count.get(user_id, 0)
+        return self._get_user_favorability(chat_id, user_id, chat_state), interaction_count
     
     def _get_favorability_level(self, favorability: float) -> tuple:
         """获取好感度等级和emoji，返回 (等级名称, emoji)"""
-        if favorability >= 85:
-            return ("挚友", "💖")
-        elif favorability >= 75:
-            return ("好友", "😊")
-        elif favorability >= 65:
-            return ("熟人", "🙂")
-        elif favorability >= 35:
-            return ("普通", "😐")
-        elif favorability >= 20:
-            return ("陌生", "😑")
-        else:
-            return ("冷淡", "😒")
+        return _FAV_LEVELS[bisect.bisect_right(_FAV_LEVEL_THRESHOLDS, favorability)]
     
     def _calculate_favorability_change(self, judge_result: JudgeResult, did_reply: bool) -> float:
         """基于5维度归一化分数计算好感度变化，返回 -5.0 到 +3.0"""
         if not self.enable_favorability:
             return 0.0
         
-        # === 归一化5个维度（0-10 → 0-1） ===
-        norm_relevance = judge_result.relevance / 10.0
-        norm_social = judge_result.social / 10.0
-        norm_continuity = judge_result.continuity / 10.0
-        norm_willingness = judge_result.willingness / 10.0
-        norm_timing = judge_result.timing / 10.0
-        
-        # === 计算综合质量分（0-1） ===
+        # === 计算综合质量分（0-1），维度归一化已并入权重元组 ===
+        w = self._fav_weight_vec
         quality_score = (
-            norm_relevance * self.fav_weights["relevance"] +
-            norm_social * self.fav_weights["social"] +
-            norm_continuity * self.fav_weights["continuity"] +
-            norm_willingness * self.fav_weights["willingness"] +
-            norm_timing * self.fav_weights["timing"]
+            judge_result.relevance * w[0] +
+            judge_result.social * w[1] +
+            judge_result.continuity * w[2] +
+            judge_result.willingness * w[3] +
+            judge_result.timing * w[4]
         )
         
         # === 映射到好感度变化（-5 到 +3） ===
-        # 使用分段线性映射
-        if quality_score > 0.8:
-            # 非常好的互动 → +2 到 +3
-            delta = 2.0 + (quality_score - 0.8) / 0.2 * 1.0
-        elif quality_score > 0.6:
-            # 良好的互动 → +0.8 到 +2
-            delta = 0.8 + (quality_score - 0.6) / 0.2 * 1.2
-        elif quality_score > 0.4:
-            # 普通互动 → -1.0 到 +0.8
-            delta = -1.0 + (quality_score - 0.4) / 0.2 * 1.8
-        elif quality_score > 0.2:
-            # 较差互动 → -2.5 到 -1.0
-            delta = -2.5 + (quality_score - 0.2) / 0.2 * 1.5
-        else:
-            # 很差的互动 → -5 到 -2.5
-            delta = -5.0 + quality_score / 0.2 * 2.5
+        # 分段线性映射：很差 -5~-2.5 | 较差 -2.5~-1.0 | 普通 -1.0~+0.8 | 良好 +0.8~+2 | 非常好 +2~+3
+        bucket = bisect.bisect_left(_FAV_DELTA_BOUNDS, quality_score)
+        delta = _FAV_DELTA_SLOPES[bucket] * quality_score + _FAV_DELTA_INTERCEPTS[bucket]
         
         # === 互动结果修正 ===
         if did_reply:
@@ -1050,85 +1537,68 @@ class HeartflowPlugin(star.Star):
         # === 限制范围 ===
         return max(-5.0, min(5.0, delta))
     
-    def _update_favorability(self, chat_id: str, user_id: str, delta: float):
-        """更新用户好感度（本地+全局），仅内存操作，插件卸载时保存到文件"""
+    def _apply_interaction(self, chat_id: str, user_id: str, delta: float, chat_state: Optional[ChatState] = None):
+        """记录一次用户互动：更新好感度并累加互动次数（本地+全局）
+
+        仅内存操作，插件卸载时保存到文件；已取得群聊状态的调用方可传入 chat_state
+        """
         if not self.enable_favorability:
             return
         
-        # 更新群聊本地好感度
-        chat_state = self._get_chat_state(chat_id)
-        
-        current = chat_state.user_favorability.get(user_id, self.initial_favorability)
-        new_value = max(0.0, min(100.0, current + delta))
-        chat_state.user_favorability[user_id] = new_value
-        
-        # 更新全局好感度（如果启用）
-        if self.enable_global_favorability:
-            # 检查白名单限制
-            can_update_global = True
-            if self.whitelist_enabled:
-                if not self.chat_whitelist or chat_id not in self.chat_whitelist:
-                    can_update_global = False  # 不在白名单中，不更新全局好感度
-            
-            if can_update_global:
-                global_current = self.global_favorability.get(user_id, self.initial_favorability)
-                global_new = max(0.0, min(100.0, global_current + delta))
-                self.global_favorability[user_id] = global_new
-        
-        if abs(delta) > 0.1:  # 只记录有意义的变化
-            logger.debug(f"好感度更新: {user_id[-4:]}... | 本地:{current:.1f}→{new_value:.1f} ({delta:+.1f})")
-    
-    def _record_interaction(self, chat_id: str, user_id: str):
-        """记录用户互动次数（本地+全局）"""
-        if not self.enable_favorability:
-            return
-        
-        # 更新群聊本地互动计数
-        chat_state = self._get_chat_state(chat_id)
-        chat_state.user_interaction_count[user_id] = \
-            chat_state.user_interaction_count.get(user_id, 0) + 1
-        
-        # 更新全局互动计数（如果启用）
-        if self.enable_global_favorability:
-            # 检查白名单限制
-            can_update_global = True
-            if self.whitelist_enabled:
-                if not self.chat_whitelist or chat_id not in self.chat_whitelist:
-                    can_update_global = False
-            
-            if can_update_global:
-                self.global_interaction_count[user_id] = \
-                    self.global_interaction_count.get(user_id, 0) + 1
+        if chat_state is None:
+            chat_state = self._get_chat_state(chat_id)
+        user_favorability = chat_state.user_favorability
+        interaction_count = chat_state.user_interaction_count
+        initial = self.initial_favorability
+        
+        # 更新群聊本地好感度和互动计数
+        current = user_favorability.get(user_id, initial)
+        # 限制在 0-100，内联比较比嵌套 max/min 调用更轻
+        new_value = current + delta
+        new_value = 0.0 if new_value < 0.0 else 100.0 if new_value > 100.0 else new_value
+        user_favorability[user_id] = new_value
+        interaction_count[user_id] = interaction_count.get(user_id, 0) + 1
+        self._favorability_dirty = True
+        
+        # 更新全局好感度和互动计数（如果启用且不受白名单限制）
+        if self._global_allowed(chat_id):
+            global_favorability = self.global_favorability
+            global_count = self.global_interaction_count
+            global_new = global_favorability.get(user_id, initial) + delta
+            global_favorability[user_id] = 0.0 if global_new < 0.0 else 100.0 if global_new > 100.0 else global_new
+            global_count[user_id] = global_count.get(user_id, 0) + 1
+        
+        # 只记录有意义的变化；先检查日志级别，未开启调试时不计算截断的用户ID
+        if abs(delta) > 0.1 and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("好感度更新: %s... | 本地:%.1f→%.1f (%+.1f)", user_id[-4:], current, new_value, delta)
     
     def _apply_favorability_decay(self, chat_id: str):
         """每日好感度衰减：向50（中性）回归，高好感衰减快，低好感恢复快"""
         chat_state = self._get_chat_state(chat_id)
         decay_rate = self.favorability_decay_daily
+        # 衰减日期本身也会被保存
+        self._favorability_dirty = True
+        
+        # 高好感度向中性回归（衰减稍快），低好感度向中性恢复（恢复更快）
+        decay_step = decay_rate * 1.5
+        recovery_step = decay_rate * 2.0
         
         # 衰减群聊本地好感度
-        for user_id in list(chat_state.user_favorability.keys()):
-            current = chat_state.user_favorability[user_id]
-            
-            if current > 50:
-                # 高好感度向中性回归（衰减稍快）
-                decay = min(current - 50, decay_rate * 1.5)
-                chat_state.user_favorability[user_id] = current - decay
-            elif current < 50:
-                # 低好感度向中性恢复（恢复更快）
-                recovery = min(50 - current, decay_rate * 2.0)
-                chat_state.user_favorability[user_id] = current + recovery
+        self._decay_toward_neutral(chat_state.user_favorability, decay_step, recovery_step)
         
         # 衰减全局好感度（如果启用）
         if self.enable_global_favorability:
-            for user_id in list(self.global_favorability.keys()):
-                current = self.global_favorability[user_id]
-                
-                if current > 50:
-                    decay = min(current - 50, decay_rate * 1.5)
-                    self.global_favorability[user_id] = current - decay
-                elif current < 50:
-                    recovery = min(50 - current, decay_rate * 2.0)
-                    self.global_favorability[user_id] = current + recovery
+            self._decay_toward_neutral(self.global_favorability, decay_step, recovery_step)
+    
+    @staticmethod
+    def _decay_toward_neutral(favorability: Dict[str, float], decay_step: float, recovery_step: float):
+        """将好感度字典中的每个值向50回归，每次最多移动一个步长，不会越过50"""
+        # 只修改值、不增删键，可直接遍历 items()
+        for user_id, current in favorability.items():
+            if current > 50:
+                favorability[user_id] = current - min(current - 50, decay_step)
+            elif current < 50:
+                favorability[user_id] = current + min(50 - current, recovery_step)
     
     def _calculate_reply_probability(self, favorability: float) -> float:
         """根据好感度计算回复概率（0.0-1.0）
@@ -1185,30 +1655,18 @@ class HeartflowPlugin(star.Star):
         try:
             message_chain = event.message_obj.message
             for component in message_chain:
-                if hasattr(component, 'type'):
-                    if component.type == 'Image':
-                        return "image"
-                    elif component.type == 'Record':
-                        return "audio"
-                    elif component.type == 'Video':
-                        return "video"
-                    elif component.type == 'File':
-                        return "file"
+                media_type = _COMPONENT_MEDIA_TYPES.get(getattr(component, 'type', None))
+                if media_type:
+                    return media_type
         except Exception as e:
-            logger.debug(f"从消息链获取媒体类型失败: {e}")
+            logger.debug("从消息链获取媒体类型失败: %s", e)
         
         logger.debug("未检测到任何媒体组件")
         return "unknown"
 
     def _get_media_label(self, media_type: str) -> str:
         """根据媒体类型返回对应的中文标签"""
-        label_mapping = {
-            "image": "图片",
-            "audio": "语音", 
-            "video": "视频",
-            "file": "文件"
-        }
-        return label_mapping.get(media_type, "媒体")
+        return _MEDIA_LABELS.get(media_type, "媒体")
     
     def _is_gif_file(self, file_path: Path) -> bool:
         """检查文件是否为GIF格式（通过文件头判断）"""
@@ -1218,7 +1676,7 @@ class HeartflowPlugin(star.Star):
                 # GIF文件头：GIF87a 或 GIF89a
                 return header.startswith(b'GIF87a') or header.startswith(b'GIF89a')
         except Exception as e:
-            logger.debug(f"检查GIF文件头失败: {e}")
+            logger.debug("检查GIF文件头失败: %s", e)
             return False
     
     async def _download_and_check_image(self, image_url: str) -> tuple[bool, Optional[Path]]:
@@ -1229,7 +1687,6 @@ class HeartflowPlugin(star.Star):
             
         try:
             # 生成缓存文件名
-            import hashlib
             url_hash = hashlib.md5(image_url.encode()).hexdigest()
             cache_file = self.image_cache_dir / f"{url_hash}.img"
             
@@ -1294,7 +1751,7 @@ class HeartflowPlugin(star.Star):
             logger.debug("检测到GIF文件，跳过识别和心流判断")
             return ""  # 返回空字符串，表示跳过处理
         
-        logger.debug(f"尝试识别图片内容，使用提示词: {prompt[:50]}...")
+        logger.debug("尝试识别图片内容，使用提示词: %.50s...", prompt)
         
         # 设置媒体识别状态，防止钩子拦截
         self.media_recognition_sessions.add(chat_id)
@@ -1307,7 +1764,7 @@ class HeartflowPlugin(star.Star):
             )
             
             result = llm_resp.completion_text if llm_resp.completion_text else "[图片识别失败]"
-            logger.debug(f"图片识别结果: {result[:100]}...")
+            logger.debug("图片识别结果: %.100s...", result)
             return result
             
         except Exception as e:
@@ -1348,7 +1805,7 @@ class HeartflowPlugin(star.Star):
                 logger.warning("未找到语音文件")
                 return "[语音识别失败：未找到语音]"
             
-            logger.debug(f"尝试识别语音内容，使用STT模型: {provider}")
+            logger.debug("尝试识别语音内容，使用STT模型: %s", provider)
             
             # 设置媒体识别状态，防止钩子拦截
             chat_id = event.unified_msg_origin
@@ -1358,7 +1815,7 @@ class HeartflowPlugin(star.Star):
                 # 使用STTProvider进行语音识别
                 result = await provider.get_text(audio_urls[0])
                 
-                logger.debug(f"语音识别结果: {result[:100]}...")
+                logger.debug("语音识别结果: %.100s...", result)
                 return result
                 
             finally:
@@ -1377,13 +1834,7 @@ class HeartflowPlugin(star.Star):
             message_chain = event.message_obj.message
             
             # 将小写的媒体类型转换为大写的组件类型
-            type_mapping = {
-                "image": "Image",
-                "audio": "Record", 
-                "video": "Video",
-                "file": "File"
-            }
-            component_type = type_mapping.get(media_type, media_type)
+            component_type = _MEDIA_COMPONENT_TYPES.get(media_type, media_type)
             
             for component in message_chain:
                 if hasattr(component, 'type') and component.type == component_type:
@@ -1392,7 +1843,7 @@ class HeartflowPlugin(star.Star):
                     elif hasattr(component, 'file') and component.file:
                         urls.append(component.file)
             
-            logger.debug(f"从消息中提取到 {len(urls)} 个{media_type}文件: {urls}")
+            logger.debug("从消息中提取到 %d 个%s文件: %s", len(urls), media_type, urls)
             
         except Exception as e:
             logger.error(f"提取{media_type}文件失败: {e}")
@@ -1400,16 +1851,16 @@ class HeartflowPlugin(star.Star):
         return urls
 
 
-    def _record_message(self, chat_id: str, role: str, content: str):
-        """记录消息到缓冲区，自动限制大小防止内存溢出，并触发智能总结"""
+    def _record_message(self, chat_id: str, role: str, content: str, now: Optional[float] = None):
+        """记录消息到缓冲区，自动限制大小防止内存溢出，并触发智能总结
+
+        now 为消息时间戳，调用方已取得当前时间时传入可避免重复读取时钟
+        """
         if chat_id not in self.message_buffer:
-            self.message_buffer[chat_id] = []
+            self.message_buffer[chat_id] = deque(maxlen=self.max_buffer_size)
         
-        self.message_buffer[chat_id].append({
-            "role": role,
-            "content": content,
-            "timestamp": time.time()
-        })
+        labeled = _CONTEXT_LABELS.get(role, "") + content
+        self.message_buffer[chat_id].append(BufferedMessage(role, content, now or time.time(), labeled))
         
         # 检查是否需要触发智能总结
         if self.enable_memory_system:
@@ -1425,7 +1876,6 @@ class HeartflowPlugin(star.Star):
         
         if buffer_size >= threshold:
             # 异步触发总结，不阻塞主流程
-            import asyncio
             try:
                 loop = asyncio.get_event_loop()
                 if loop.is_running():
@@ -1444,7 +1894,8 @@ class HeartflowPlugin(star.Star):
                 return
                 
             # 获取需要总结的消息（前70%的消息）
-            messages_to_summarize = self.message_buffer[chat_id][:int(len(self.message_buffer[chat_id]) * 0.7)]
+            buffer = self.message_buffer[chat_id]
+            messages_to_summarize = list(islice(buffer, int(len(buffer) * 0.7)))
             
             if len(messages_to_summarize) < 5:  # 消息太少，不总结
                 return
@@ -1468,8 +1919,12 @@ class HeartflowPlugin(star.Star):
                     self.memory_system[chat_id]["summaries"] = self.memory_system[chat_id]["summaries"][-10:]
                 
                 # 从缓冲区中移除已总结的消息，保留最近30%
-                keep_count = int(len(self.message_buffer[chat_id]) * 0.3)
-                self.message_buffer[chat_id] = self.message_buffer[chat_id][-keep_count:]
+                buffer = self.message_buffer[chat_id]
+                keep_count = int(len(buffer) * 0.3)
+                self.message_buffer[chat_id] = deque(
+                    islice(buffer, len(buffer) - keep_count, None),
+                    maxlen=self.max_buffer_size
+                )
                 
                 logger.info(f"群聊 {chat_id} 完成智能总结，保留 {keep_count} 条最新消息")
                 
@@ -1488,13 +1943,16 @@ class HeartflowPlugin(star.Star):
 对话内容：
 """
         
-        for msg in messages:
-            role = msg.get("role", "")
-            content = msg.get("content", "")
-            timestamp = msg.get("timestamp", 0)
+        # 同一分钟内的消息复用格式化后的时间
+        minute_strs: Dict[int, str] = {}
+        for role, content, timestamp, _ in messages:
             
             # 格式化时间
-            time_str = time.strftime("%H:%M", time.localtime(timestamp))
+            minute = int(timestamp) // 60
+            time_str = minute_strs.get(minute)
+            if time_str is None:
+                time_str = time.strftime("%H:%M", time.localtime(timestamp))
+                minute_strs[minute] = time_str
             
             if role == "user":
                 prompt += f"[{time_str}] 用户: {content}\n"
@@ -1541,8 +1999,8 @@ class HeartflowPlugin(star.Star):
             return
         self.blacklist_system[user_id] = True
         logger.warning(f"用户 {user_id} 已被AI拉黑")
-        # 自动保存拉黑状态
-        self._save_blacklist()
+        # 自动保存拉黑状态（延迟合并写入，不阻塞消息处理）
+        self._schedule_blacklist_save()
     
     def _unblacklist_user(self, user_id: str):
         """解封用户"""
@@ -1550,8 +2008,8 @@ class HeartflowPlugin(star.Star):
             return
         self.blacklist_system[user_id] = False
         logger.info(f"用户 {user_id} 已被AI解封")
-        # 自动保存拉黑状态
-        self._save_blacklist()
+        # 自动保存拉黑状态（延迟合并写入，不阻塞消息处理）
+        self._schedule_blacklist_save()
     
     async def _get_recent_contexts(self, event: AstrMessageEvent, add_labels: bool = False) -> list:
         """获取最近的对话上下文
@@ -1563,61 +2021,93 @@ class HeartflowPlugin(star.Star):
         
         # 使用插件缓冲区
         if chat_id not in self.message_buffer or not self.message_buffer[chat_id]:
-            logger.debug(f"缓冲区为空，返回空上下文（首次运行或刚重载）")
+            logger.debug("缓冲区为空，返回空上下文（首次运行或刚重载）")
             return []
         
         buffer_messages = self.message_buffer[chat_id]
-        # 获取最近的 context_messages_count 条消息
-        recent_messages = buffer_messages[-self.context_messages_count:] if len(buffer_messages) > self.context_messages_count else buffer_messages
+        # 获取最近的 context_messages_count 条消息（deque不支持切片）
+        recent_messages = islice(buffer_messages, max(0, len(buffer_messages) - self.context_messages_count), None)
+        
+        # 小模型使用写入时已添加标注的内容，帮助识别对话对象；大模型保持原始格式
+        # 每次返回新建的字典，调用方（及下游框架）修改上下文不会影响缓冲区
+        if add_labels:
+            filtered_context = [
+                {"role": role, "content": labeled}
+                for role, content, _, labeled in recent_messages
+                if role in _CONTEXT_LABELS and content
+            ]
+        else:
+            filtered_context = [
+                {"role": role, "content": content}
+                for role, content, _, _ in recent_messages
+                if role in _CONTEXT_LABELS and content
+            ]
         
-        filtered_context = []
-        for msg in recent_messages:
-            role = msg.get("role", "")
-            content = msg.get("content", "")
-            
-            if role in ["user", "assistant"] and content:
-                if add_labels:
-                    # 为小模型添加标注，帮助识别对话对象
-                    if role == "user":
-                        clean_msg = {
-                            "role": role,
-                            "content": f"[群友消息] {content}"
-                        }
-                    else:  # assistant
-                        clean_msg = {
-                            "role": role,
-                            "content": f"[我的回复] {content}"
-                        }
-                else:
-                    # 为大模型保持原始格式
-                    clean_msg = {
-                        "role": role,
-                        "content": content
-                    }
-                filtered_context.append(clean_msg)
-        
-        logger.debug(f"⭐ 从缓冲区获取到 {len(filtered_context)} 条消息 | 缓冲区总数: {len(buffer_messages)}")
+        logger.debug("⭐ 从缓冲区获取到 %d 条消息 | 缓冲区总数: %d", len(filtered_context), len(buffer_messages))
         return filtered_context
 
-    def _update_active_state(self, event: AstrMessageEvent, judge_result: JudgeResult):
-        """更新主动回复状态"""
+    def _update_active_state(self, event: AstrMessageEvent, judge_result: JudgeResult, now: Optional[float] = None,
+                             chat_state: Optional[ChatState] = None):
+        """更新主动回复状态（now 为本条消息的时间戳，未传入时读取当前时间；chat_state 未传入时重新获取）"""
         chat_id = event.unified_msg_origin
-        chat_state = self._get_chat_state(chat_id)
+        if chat_state is None:
+            chat_state = self._get_chat_state(chat_id)
 
         # 更新回复相关状态
-        chat_state.last_reply_time = time.time()
+        chat_state.last_reply_time = now or time.time()
         chat_state.total_replies += 1
         chat_state.total_messages += 1
 
         # 精力消耗（回复后精力下降）
         chat_state.energy = max(0.1, chat_state.energy - self.energy_decay_rate)
 
-        logger.debug(f"更新主动状态: {chat_id[:20]}... | 精力: {chat_state.energy:.2f}")
+        logger.debug("更新主动状态: %.20s... | 精力: %.2f", chat_id, chat_state.energy)
 
-    async def _update_passive_state(self, event: AstrMessageEvent, judge_result: JudgeResult):
-        """更新被动状态：消息统计+1，精力缓慢恢复"""
+    def _judge_context_signature(self, chat_id: str, own_content: str) -> Optional[float]:
+        """判断缓存的上下文签名：缓冲区中最新一条不同于本条消息的时间戳
+
+        own_content 与 on_group_message 写入缓冲区的内容格式一致；跳过同一用户连续重复的相同消息，
+        其余任何新消息（包括机器人回复）都会改变签名
+        """
+        buffer = self.message_buffer.get(chat_id)
+        if buffer:
+            for msg in reversed(buffer):
+                if msg.content != own_content:
+                    return msg.timestamp
+        return None
+
+    def _prefilter_judge(self, chat_id: str, user_id: str, message_text: str, now: float) -> str:
+        """规则预过滤，返回跳过判断的原因；返回空字符串表示需要小模型判断
+
+        同一用户在 _prefilter_repeat_window 秒内重复发送相同内容才视为重复消息
+        """
+        text = message_text.strip()
+        text_hash = hash(text)
+        key = (chat_id, user_id)
+        records = self._last_user_message
+        last = records.get(key)
+        records[key] = (text_hash, now)
+        records.move_to_end(key)
+        # 记录按时间先后排列，从最旧一端淘汰过期记录，超出上限时再淘汰最旧的记录
+        expire_before = now - self._prefilter_repeat_window
+        while records and (len(records) > self._prefilter_max_entries
+                           or next(iter(records.values()))[1] < expire_before):
+            records.popitem(last=False)
+
+        if len(text) < 2:
+            return "消息过短"
+        if _URL_ONLY_RE.fullmatch(text):
+            return "纯链接"
+        if last is not None and last[0] == text_hash and now - last[1] < self._prefilter_repeat_window:
+            return "重复消息"
+        return ""
+
+    async def _update_passive_state(self, event: AstrMessageEvent, judge_result: JudgeResult,
+                                    chat_state: Optional[ChatState] = None):
+        """更新被动状态：消息统计+1，精力缓慢恢复（chat_state 未传入时重新获取）"""
         chat_id = event.unified_msg_origin
-        chat_state = self._get_chat_state(chat_id)
+        if chat_state is None:
+            chat_state = self._get_chat_state(chat_id)
 
         # 更新消息计数
         chat_state.total_messages += 1
@@ -1625,7 +2115,7 @@ class HeartflowPlugin(star.Star):
         # 精力恢复（不回复时精力缓慢恢复）
         chat_state.energy = min(1.0, chat_state.energy + self.energy_recovery_rate)
 
-        logger.debug(f"更新被动状态: {chat_id[:20]}... | 精力: {chat_state.energy:.2f} | 原因: {judge_result.reasoning[:30]}...")
+        logger.debug("更新被动状态: %.20s... | 精力: %.2f | 原因: %.30s...", chat_id, chat_state.energy, judge_result.reasoning)
 
     # 管理员命令：查看心流状态
     @filter.command("heartflow")
@@ -1644,9 +2134,17 @@ class HeartflowPlugin(star.Star):
             
             total_users = len(fav_data)
             if total_users > 0:
-                avg_fav = sum(fav_data.values()) / total_users
-                high_fav = len([f for f in fav_data.values() if f >= 70])
-                low_fav = len([f for f in fav_data.values() if f <= 30])
+                # 单次遍历同时统计总和与高/低好感人数
+                fav_sum = 0.0
+                high_fav = 0
+                low_fav = 0
+                for f in fav_data.values():
+                    fav_sum += f
+                    if f >= 70:
+                        high_fav += 1
+                    elif f <= 30:
+                        low_fav += 1
+                avg_fav = fav_sum / total_users
                 fav_stats = f"""
 好感度统计（{fav_scope}）:
 - 记录用户数: {total_users}
@@ -1655,38 +2153,19 @@ class HeartflowPlugin(star.Star):
 - 低好感用户: {low_fav}个 (≤30)
 """
 
-        status_info = f"""
-心流状态报告
-
-当前状态:
-- 群聊ID: {event.unified_msg_origin}
-- 精力水平: {chat_state.energy:.2f}/1.0 {'高' if chat_state.energy > 0.7 else '中' if chat_state.energy > 0.3 else '低'}
-- 上次回复: {self._get_minutes_since_last_reply(chat_id)}分钟前
-
-历史统计:
-- 总消息数: {chat_state.total_messages}
-- 总回复数: {chat_state.total_replies}
-- 回复率: {(chat_state.total_replies / max(1, chat_state.total_messages) * 100):.1f}%
-
-配置参数:
-        - 回复阈值: {self.reply_threshold}
-        - 判断提供商: {self.judge_provider_name}
-        - 白名单模式: {'开启' if self.whitelist_enabled else '关闭'}
-- 白名单群聊数: {len(self.chat_whitelist) if self.whitelist_enabled else 0}
-
-智能缓存:
-- 系统提示词缓存: {len(self.system_prompt_cache)} 个
-- 消息缓冲区: {len(self.message_buffer[chat_id]) if chat_id in self.message_buffer else 0}/{self.max_buffer_size} 条
-
-评分权重:
-- 内容相关度: {self.weights['relevance']:.0%}
-- 回复意愿: {self.weights['willingness']:.0%}
-- 社交适宜性: {self.weights['social']:.0%}
-- 时机恰当性: {self.weights['timing']:.0%}
-- 对话连贯性: {self.weights['continuity']:.0%}
-
-{fav_stats}
-"""
+        status_info = _STATUS_TEMPLATE.format_map({
+            **self._status_static_fields,
+            "chat_id": chat_id,
+            "energy": chat_state.energy,
+            "energy_level": '高' if chat_state.energy > 0.7 else '中' if chat_state.energy > 0.3 else '低',
+            "minutes_since_reply": self._get_minutes_since_last_reply(chat_id, chat_state),
+            "total_messages": chat_state.total_messages,
+            "total_replies": chat_state.total_replies,
+            "reply_rate": chat_state.total_replies / max(1, chat_state.total_messages) * 100,
+            "prompt_cache_count": len(self.system_prompt_cache),
+            "buffer_count": len(self.message_buffer[chat_id]) if chat_id in self.message_buffer else 0,
+            "fav_stats": fav_stats
+        })
 
         event.set_result(event.plain_result(status_info))
 
@@ -1698,6 +2177,7 @@ class HeartflowPlugin(star.Star):
         chat_id = event.unified_msg_origin
         if chat_id in self.chat_states:
             del self.chat_states[chat_id]
+            self._favorability_dirty = True
 
         event.set_result(event.plain_result("心流状态已重置"))
         logger.info(f"心流状态已重置: {chat_id}")
@@ -1707,24 +2187,27 @@ class HeartflowPlugin(star.Star):
     async def heartflow_cache_status(self, event: AstrMessageEvent):
         """查看系统提示词缓存状态"""
         
-        cache_info = "系统提示词缓存状态\n\n"
+        parts = ["系统提示词缓存状态\n\n"]
         
         if not self.system_prompt_cache:
-            cache_info += "当前无缓存记录"
+            parts.append("当前无缓存记录")
         else:
-            cache_info += f"总缓存数量: {len(self.system_prompt_cache)}\n\n"
+            parts.append(f"总缓存数量: {len(self.system_prompt_cache)}\n\n")
             
             for cache_key, cache_data in self.system_prompt_cache.items():
                 original_len = len(cache_data.get("original", ""))
-                summarized_len = len(cache_data.get("summarized", ""))
+                summarized = cache_data.get("summarized", "")
+                summarized_len = len(summarized)
                 persona_id = cache_data.get("persona_id", "unknown")
                 
-                cache_info += f"缓存键: {cache_key}\n"
-                cache_info += f"人格ID: {persona_id}\n"
-                cache_info += f"压缩率: {original_len} -> {summarized_len} ({(1-summarized_len/max(1,original_len))*100:.1f}% 压缩)\n"
-                cache_info += f"精简内容: {cache_data.get('summarized', '')[:100]}...\n\n"
+                parts.append(
+                    f"缓存键: {cache_key}\n"
+                    f"人格ID: {persona_id}\n"
+                    f"压缩率: {original_len} -> {summarized_len} ({(1-summarized_len/max(1,original_len))*100:.1f}% 压缩)\n"
+                    f"精简内容: {summarized[:100]}...\n\n"
+                )
         
-        event.set_result(event.plain_result(cache_info))
+        event.set_result(event.plain_result("".join(parts)))
 
     # 管理员命令：清除系统提示词缓存
     @filter.command("heartflow_cache_clear")
@@ -1733,7 +2216,15 @@ class HeartflowPlugin(star.Star):
         
         cache_count = len(self.system_prompt_cache)
         self.system_prompt_cache.clear()
-        
+        self._judge_prefix_cache.clear()
+        self._persona_prompt_cache.clear()
+        self._conv_meta_cache.clear()
+        self._judge_cache.clear()
+        # 同时清除持久化缓存，下次使用时重新总结
+        if self.summary_cache:
+            self.summary_cache.clear()
+            self._summary_cache_dirty = True
+
         event.set_result(event.plain_result(f"已清除 {cache_count} 个系统提示词缓存"))
         logger.info(f"系统提示词缓存已清除，共清除 {cache_count} 个缓存")
 
@@ -1744,21 +2235,21 @@ class HeartflowPlugin(star.Star):
         
         chat_id = event.unified_msg_origin
         
-        buffer_info = "消息缓冲区状态\n\n"
-        
-        if chat_id not in self.message_buffer or not self.message_buffer[chat_id]:
-            buffer_info += "当前群聊缓冲区为空"
+        buffer = self.message_buffer.get(chat_id)
+        if not buffer:
+            buffer_info = "消息缓冲区状态\n\n当前群聊缓冲区为空"
         else:
-            buffer = self.message_buffer[chat_id]
-            buffer_info += f"缓冲区消息数量: {len(buffer)}/{self.max_buffer_size}\n\n"
-            buffer_info += "最近10条消息:\n"
-            
-            recent_10 = buffer[-10:] if len(buffer) > 10 else buffer
-            for i, msg in enumerate(recent_10, 1):
-                role = msg.get("role", "")
-                content = msg.get("content", "")
-                role_text = "群友" if role == "user" else "我"
-                buffer_info += f"{i}. [{role_text}] {content[:50]}...\n"
+            recent_10 = islice(buffer, max(0, len(buffer) - 10), None)
+            lines = [
+                f"{i}. [{_ROLE_USER_TEXT if role == 'user' else _ROLE_BOT_TEXT}] {(content or '')[:50]}...\n"
+                for i, (role, content, _, _) in enumerate(recent_10, 1)
+            ]
+            buffer_info = "".join([
+                "消息缓冲区状态\n\n",
+                f"缓冲区消息数量: {len(buffer)}/{self.max_buffer_size}\n\n",
+                "最近10条消息:\n",
+                *lines
+            ])
         
         event.set_result(event.plain_result(buffer_info))
     
@@ -1790,8 +2281,7 @@ class HeartflowPlugin(star.Star):
         user_name = event.get_sender_name()
         
         # 获取实际使用的好感度
-        user_fav = self._get_user_favorability(chat_id, user_id)
-        interaction_count = self._get_user_interaction_count(chat_id, user_id)
+        user_fav, interaction_count = self._get_user_fav_and_count(chat_id, user_id)
         level, emoji = self._get_favorability_level(user_fav)
         reply_prob = self._calculate_reply_probability(user_fav)
         
@@ -1837,23 +2327,24 @@ class HeartflowPlugin(star.Star):
             event.set_result(event.plain_result("当前群聊暂无好感度记录"))
             return
         
-        # 排序
-        sorted_users = sorted(
+        # 只取前10名，无需对全部用户排序
+        top_users = heapq.nlargest(
+            10,
             chat_state.user_favorability.items(),
-            key=lambda x: x[1],
-            reverse=True
+            key=lambda x: x[1]
         )
+        total_users = len(chat_state.user_favorability)
         
-        result = "好感度排行榜\n\n"
-        for i, (uid, fav) in enumerate(sorted_users[:10], 1):
+        parts = ["好感度排行榜\n\n"]
+        for i, (uid, fav) in enumerate(top_users, 1):
             level, emoji = self._get_favorability_level(fav)
             interaction = chat_state.user_interaction_count.get(uid, 0)
-            result += f"{i}. 用户{uid[-6:]}: {fav:.0f}/100 {emoji} ({level}, {interaction}次互动)\n"
+            parts.append(f"{i}. 用户{uid[-6:]}: {fav:.0f}/100 {emoji} ({level}, {interaction}次互动)\n")
         
-        if len(sorted_users) > 10:
-            result += f"\n...还有{len(sorted_users) - 10}个用户"
+        if total_users > 10:
+            parts.append(f"\n...还有{total_users - 10}个用户")
         
-        event.set_result(event.plain_result(result))
+        event.set_result(event.plain_result("".join(parts)))
     
     # 管理员命令：重置好感度
     @filter.command("heartflow_fav_reset")
@@ -1871,6 +2362,7 @@ class HeartflowPlugin(star.Star):
         user_count = len(chat_state.user_favorability)
         chat_state.user_favorability.clear()
         chat_state.user_interaction_count.clear()
+        self._favorability_dirty = True
         
         # 如果启用全局好感度，同时清理全局好感度
         if self.enable_global_favorability:
@@ -1890,15 +2382,10 @@ class HeartflowPlugin(star.Star):
             return
         
         try:
-            self._save_favorability()
+            await self._save_favorability(force=True)
             
             # 统计保存的数据
-            total_chats = 0
-            total_users = 0
-            for state in self.chat_states.values():
-                if state.user_favorability:
-                    total_chats += 1
-                    total_users += len(state.user_favorability)
+            total_chats, total_users = self._count_favorability_stats()
             
             event.set_result(event.plain_result(
                 f"✅ 好感度数据已手动保存\n\n"
@@ -1907,10 +2394,10 @@ class HeartflowPlugin(star.Star):
                 f"用户数: {total_users}\n"
                 f"保存策略: 插件重载/停止时保存"
             ))
-            logger.info(f"手动保存好感度数据: {total_chats}个群聊, {total_users}个用户")
+            logger.info("手动保存好感度数据: %d个群聊, %d个用户", total_chats, total_users)
         except Exception as e:
             event.set_result(event.plain_result(f"保存失败: {e}"))
-            logger.error(f"手动保存好感度失败: {e}")
+            logger.error("手动保存好感度失败: %s", e)
     
     # AI拉黑系统管理命令
     @filter.command("heartflow_blacklist_status")
@@ -1923,17 +2410,17 @@ class HeartflowPlugin(star.Star):
         
         blacklist_count = sum(1 for blacklisted in self.blacklist_system.values() if blacklisted)
         
-        result = f"🤖 AI拉黑系统状态\n\n"
-        result += f"系统状态: {'启用' if self.enable_blacklist else '禁用'}\n"
-        result += f"当前拉黑用户数: {blacklist_count}\n\n"
+        parts = [
+            "🤖 AI拉黑系统状态\n\n",
+            f"系统状态: {'启用' if self.enable_blacklist else '禁用'}\n",
+            f"当前拉黑用户数: {blacklist_count}\n\n",
+        ]
         
         if blacklist_count > 0:
-            result += "被拉黑用户:\n"
-            for user_id, blacklisted in self.blacklist_system.items():
-                if blacklisted:
-                    result += f"- {user_id}\n"
+            parts.append("被拉黑用户:\n")
+            parts.extend(f"- {user_id}\n" for user_id, blacklisted in self.blacklist_system.items() if blacklisted)
         
-        event.set_result(event.plain_result(result))
+        event.set_result(event.plain_result("".join(parts)))
     
     @filter.command("heartflow_unblacklist")
     async def heartflow_unblacklist(self, event: AstrMessageEvent):
@@ -1960,66 +2447,147 @@ class HeartflowPlugin(star.Star):
     
     async def terminate(self):
         """插件卸载/停用时调用，保存数据"""
+        self._save_summary_cache()
+        
         if self.enable_favorability:
-            self._save_favorability()
+            await self._save_favorability()
             
             # 统计保存的数据
-            total_chats = sum(1 for state in self.chat_states.values() if state.user_favorability)
-            total_users = sum(len(state.user_favorability) for state in self.chat_states.values() if state.user_favorability)
+            total_chats, total_users = self._count_favorability_stats()
             
-            logger.info(f"✅ 插件卸载，好感度数据已保存到文件 | {total_chats}个群聊, {total_users}个用户")
+            logger.info("✅ 插件卸载，好感度数据已保存到文件 | %d个群聊, %d个用户", total_chats, total_users)
         
         if self.enable_blacklist:
-            self._save_blacklist()
+            # 跳过延迟，等待保存任务写入最终状态；正在进行的写入完成后会再保存一次
+            self._blacklist_flush_now.set()
+            self._schedule_blacklist_save()
+            await self._blacklist_save_task
             
             # 统计保存的数据
             blacklist_count = sum(1 for blacklisted in self.blacklist_system.values() if blacklisted)
             
-            logger.info(f"✅ 插件卸载，拉黑状态已保存到文件 | {len(self.blacklist_system)}个用户记录, {blacklist_count}个被拉黑")
+            logger.info("✅ 插件卸载，拉黑状态已保存到文件 | %d个用户记录, %d个被拉黑", len(self.blacklist_system), blacklist_count)
 
     async def _get_persona_system_prompt(self, event: AstrMessageEvent) -> str:
-        """获取当前对话的人格系统提示词"""
+        """获取当前对话的人格系统提示词（按会话缓存 _persona_cache_ttl 秒）"""
+        # 未配置任何人格时结果必为空，无需查询会话管理器
+        try:
+            if not self.context.provider_manager.personas:
+                return ""
+        except Exception as e:
+            logger.debug("获取人格列表失败: %s", e)
+            return ""
+
+        umo = event.unified_msg_origin
+        now = time.monotonic()
+        cached = self._persona_prompt_cache.get(umo)
+        if cached is not None and now - cached[0] < self._persona_cache_ttl:
+            self._persona_prompt_cache.move_to_end(umo)
+            return cached[1]
+
+        prompt = await self._resolve_persona_system_prompt(event)
+        self._persona_prompt_cache[umo] = (now, prompt)
+        self._persona_prompt_cache.move_to_end(umo)
+        while len(self._persona_prompt_cache) > self._persona_cache_size:
+            self._persona_prompt_cache.popitem(last=False)
+        return prompt
+
+    async def _resolve_persona_system_prompt(self, event: AstrMessageEvent) -> str:
+        """从会话管理器解析当前对话的人格系统提示词，任何环节失败时返回空字符串"""
+        # 会话管理器查询、人格列表和默认人格的访问都可能因属性或结构异常失败，统一回退为空提示词
         try:
-            # 获取当前对话
-            curr_cid = await self.context.conversation_manager.get_curr_conversation_id(event.unified_msg_origin)
+            curr_cid, has_conversation, persona_id = await self._get_conversation_meta(event.unified_msg_origin)
+
             if not curr_cid:
                 # 如果没有对话ID，使用默认人格
-                default_persona_name = self.context.provider_manager.selected_default_persona["name"]
-                return self._get_persona_prompt_by_name(default_persona_name)
+                return self._get_default_persona_prompt()
 
-            conversation = await self.context.conversation_manager.get_conversation(event.unified_msg_origin, curr_cid)
-            if not conversation:
+            if not has_conversation:
                 # 如果没有对话对象，使用默认人格
-                default_persona_name = self.context.provider_manager.selected_default_persona["name"]
-                return self._get_persona_prompt_by_name(default_persona_name)
-
-            # 获取人格ID
-            persona_id = conversation.persona_id
+                return self._get_default_persona_prompt()
 
             if not persona_id:
                 # persona_id 为 None 时，使用默认人格
-                persona_id = self.context.provider_manager.selected_default_persona["name"]
-            elif persona_id == "[%None]":
+                return self._get_default_persona_prompt()
+            elif persona_id == _NO_PERSONA:
                 # 用户显式取消人格时，不使用任何人格
                 return ""
 
             return self._get_persona_prompt_by_name(persona_id)
-
         except Exception as e:
-            logger.debug(f"获取人格系统提示词失败: {e}")
+            logger.debug("获取人格系统提示词失败: %s", e)
             return ""
 
-    def _get_persona_prompt_by_name(self, persona_name: str) -> str:
-        """根据人格名称获取人格提示词"""
-        try:
-            # 从provider_manager中查找人格
-            for persona in self.context.provider_manager.personas:
-                if persona["name"] == persona_name:
-                    return persona.get("prompt", "")
+    async def _get_conversation_meta(self, umo: str) -> tuple:
+        """获取 (当前会话ID, 会话是否存在, 人格ID)，按会话缓存 _persona_cache_ttl 秒
 
-            logger.debug(f"未找到人格: {persona_name}")
-            return ""
+        同一条消息的判断会先后查询人格提示词和精简提示词，缓存后只需访问一次会话管理器
+        """
+        now = time.monotonic()
+        cached = self._conv_meta_cache.get(umo)
+        if cached is not None and now - cached[0] < self._persona_cache_ttl:
+            self._conv_meta_cache.move_to_end(umo)
+            return cached[1:]
+
+        task = self._conv_meta_inflight.get(umo)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_conversation_meta(umo))
+            self._conv_meta_inflight[umo] = task
+            task.add_done_callback(lambda _: self._conv_meta_inflight.pop(umo, None))
+        # shield：某个等待者被取消时不影响其他共享该查询的请求
+        return await asyncio.shield(task)
+
+    async def _fetch_conversation_meta(self, umo: str) -> tuple:
+        """查询会话管理器并写入会话元信息缓存"""
+        conversation_manager = self.context.conversation_manager
+        curr_cid = await conversation_manager.get_curr_conversation_id(umo)
+        has_conversation = False
+        persona_id = None
+        if curr_cid:
+            conversation = await conversation_manager.get_conversation(umo, curr_cid)
+            if conversation:
+                has_conversation = True
+                persona_id = conversation.persona_id
+                # 人格ID会参与缓存键和哨兵比较，驻留后比较可直接命中身份判断
+                if isinstance(persona_id, str):
+                    persona_id = sys.intern(persona_id)
+
+        self._conv_meta_cache[umo] = (time.monotonic(), curr_cid, has_conversation, persona_id)
+        self._conv_meta_cache.move_to_end(umo)
+        while len(self._conv_meta_cache) > self._persona_cache_size:
+            self._conv_meta_cache.popitem(last=False)
+        return curr_cid, has_conversation, persona_id
+
+    def _get_default_persona_prompt(self) -> str:
+        """获取默认人格的提示词"""
+        provider_manager = self.context.provider_manager
+        # 未选择默认人格时名称为 None，按名称查找会得到空提示词
+        default_name = (provider_manager.selected_default_persona or {}).get("name")
+        # 经人格索引查找，每次读取人格字典的当前 prompt，人格被原地编辑时也能立即生效
+        return self._get_persona_prompt_by_name(default_name)
+
+    def _get_persona_by_name(self, persona_name: str) -> Optional[dict]:
+        """根据人格名称获取人格字典，不存在时返回 None"""
+        # 人格列表变化时重建索引，之后按名称直接查找
+        personas = self.context.provider_manager.personas or ()
+        if personas is not self._persona_list_ref or len(personas) != self._persona_list_len:
+            # 倒序构建，保证同名人格取列表中第一个（与原线性查找一致）
+            # 名称驻留后，与驻留过的人格ID查找时可直接命中身份比较
+            index = {}
+            for p in reversed(personas):
+                name = p.get("name")
+                if isinstance(name, str):
+                    name = sys.intern(name)
+                index[name] = p
+            self._persona_index = index
+            self._persona_list_ref = personas
+            self._persona_list_len = len(personas)
+        return self._persona_index.get(persona_name)
 
-        except Exception as e:
-            logger.debug(f"获取人格提示词失败: {e}")
+    def _get_persona_prompt_by_name(self, persona_name: str) -> str:
+        """根据人格名称获取人格提示词"""
+        persona = self._get_persona_by_name(persona_name)
+        if persona is None:
+            logger.debug("未找到人格: %s", persona_name)
             return ""
+        return persona.get("prompt") or ""